@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+import deadlines
+
+# Per-stage limits: concurrent calls, callers allowed to wait, and how long they may wait (seconds)
+STAGE_LIMITS = {
+    "stt": (int(os.environ.get("STT_CONCURRENCY", "8")), int(os.environ.get("STT_QUEUE", "32"))),
+    "vision": (int(os.environ.get("VISION_CONCURRENCY", "8")), int(os.environ.get("VISION_QUEUE", "32"))),
+    "tts": (int(os.environ.get("TTS_CONCURRENCY", "8")), int(os.environ.get("TTS_QUEUE", "32"))),
+    "pdf": (int(os.environ.get("PDF_CONCURRENCY", "4")), int(os.environ.get("PDF_QUEUE", "16"))),
+}
+STAGE_MAX_WAIT = float(os.environ.get("STAGE_MAX_WAIT", "30"))
+
+# Token bucket per session (or client IP): sustained requests per minute and burst size
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "6"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "3"))
+RATE_LIMIT_KEY = os.environ.get("RATE_LIMIT_KEY", "session")
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))
+
+class AdmissionRejected(Exception):
+    """Raised when a request is turned away instead of being queued."""
+    
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class StageLimiter:
+    """
+    Concurrency limit for one pipeline stage with a bounded wait queue.
+    
+    Use as "async with limiter:". Up to concurrency callers run at once, up to
+    max_queue more wait (each for at most max_wait seconds, or until the
+    request deadline), and anyone beyond that is rejected immediately with
+    AdmissionRejected.
+    """
+    
+    def __init__(self, name, concurrency, max_queue, max_wait=STAGE_MAX_WAIT):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+    
+    async def __aenter__(self):
+        # Everyone waiting or running counts, so a burst cannot overshoot the queue bound
+        if self.queued + self.in_flight >= self.concurrency + self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"The {self.name} queue is full")
+        
+        # Waiting past the request deadline would only delay the inevitable timeout
+        max_wait = self.max_wait
+        left = deadlines.remaining()
+        if left is not None:
+            max_wait = max(left, 0) if max_wait is None else min(max_wait, max(left, 0))
+        
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max_wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise AdmissionRejected(f"Timed out waiting for the {self.name} stage")
+        finally:
+            self.queued -= 1
+        
+        waited = time.perf_counter() - start
+        self.admitted += 1
+        self.in_flight += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._semaphore.release()
+        return False
+    
+    def metrics(self):
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+        }
+
+class RateLimiter:
+    """Token bucket per key (session or client IP), forgetting the least recently seen keys."""
+    
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def check(self, key):
+        """
+        Take a token for a key.
+        
+        Args:
+            key (str): Session ID or client address
+            
+        Raises:
+            AdmissionRejected: If the key has no tokens left, with retry_after in seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (float(self.burst), now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            if not allowed:
+                self.limited += 1
+        if not allowed:
+            retry_after = (1 - tokens) / self.rate if self.rate > 0 else None
+            raise AdmissionRejected("Too many requests", retry_after=retry_after)
+    
+    def metrics(self):
+        with self._lock:
+            return {"tracked_keys": len(self._buckets), "limited": self.limited}
+
+stage_limiters = {
+    name: StageLimiter(name, concurrency, max_queue)
+    for name, (concurrency, max_queue) in STAGE_LIMITS.items()
+}
+rate_limiter = RateLimiter()
+
+def rate_limit_key(request):
+    """
+    Pick the rate limit key for a Gradio request.
+    
+    Args:
+        request (gr.Request): The incoming request, or None
+        
+    Returns:
+        str: The client IP when RATE_LIMIT_KEY is "ip", otherwise the session hash
+    """
+    if request is None:
+        return "default"
+    if RATE_LIMIT_KEY == "ip" and request.client is not None:
+        return request.client.host
+    return request.session_hash or "default"
+
+def admission_metrics() -> dict:
+    """
+    Report queue depth, wait times and rejections for every stage, plus rate limiting.
+    
+    Returns:
+        dict: Per-stage limiter metrics and rate limiter counters
+    """
+    return {
+        "stages": {name: limiter.metrics() for name, limiter in stage_limiters.items()},
+        "rate_limit": rate_limiter.metrics(),
+    }
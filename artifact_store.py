@@ -0,0 +1,190 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import logging
+
+# Generated audio and PDFs live under ARTIFACT_DIR, one subdirectory per session
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "medicalbot-artifacts"))
+ARTIFACT_MAX_BYTES = int(os.environ.get("ARTIFACT_MAX_BYTES", str(1024 * 1024 * 1024)))
+ARTIFACT_MAX_AGE = float(os.environ.get("ARTIFACT_MAX_AGE", "3600"))
+ARTIFACT_SWEEP_INTERVAL = float(os.environ.get("ARTIFACT_SWEEP_INTERVAL", "60"))
+# Other directories to age out with the same policy, e.g. .gradio/flagged (os.pathsep separated)
+ARTIFACT_EXTRA_DIRS = [d for d in os.environ.get("ARTIFACT_EXTRA_DIRS", "").split(os.pathsep) if d]
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+class ArtifactStore:
+    """
+    Per-session temporary files with an age and size quota.
+    
+    Every artifact gets its own directory under <root>/<session>/ so callers can
+    keep meaningful file names. A background thread periodically deletes
+    artifacts older than max_age, then the oldest ones until the store is under
+    max_bytes, and reports what it holds through metrics().
+    """
+    
+    def __init__(self, root=ARTIFACT_DIR, max_bytes=ARTIFACT_MAX_BYTES, max_age=ARTIFACT_MAX_AGE,
+                 sweep_interval=ARTIFACT_SWEEP_INTERVAL, extra_dirs=ARTIFACT_EXTRA_DIRS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.extra_dirs = list(extra_dirs)
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop = threading.Event()
+        self._metrics = {
+            "bytes_held": 0,
+            "files_held": 0,
+            "sessions": 0,
+            "files_created": 0,
+            "files_swept": 0,
+            "bytes_swept": 0,
+            "last_sweep": None,
+        }
+    
+    def session_dir(self, session_id):
+        """
+        Return (and create) the directory holding a session's artifacts.
+        
+        Args:
+            session_id (str): The session the artifacts belong to
+            
+        Returns:
+            str: Absolute path of the session directory
+        """
+        name = _UNSAFE_CHARS.sub("_", session_id or "shared")
+        path = os.path.join(self.root, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+    
+    def new_path(self, session_id, filename):
+        """
+        Reserve a path for a new artifact.
+        
+        Args:
+            session_id (str): The session the artifact belongs to
+            filename (str): File name the artifact should have (e.g. "prescription.pdf")
+            
+        Returns:
+            str: A path in a fresh directory; the caller writes the file
+        """
+        self.start_sweeper()
+        artifact_dir = os.path.join(self.session_dir(session_id), uuid.uuid4().hex)
+        os.makedirs(artifact_dir)
+        with self._lock:
+            self._metrics["files_created"] += 1
+        return os.path.join(artifact_dir, filename)
+    
+    def remove_session(self, session_id):
+        """Delete every artifact of a session."""
+        name = _UNSAFE_CHARS.sub("_", session_id or "shared")
+        shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+    
+    def _scan(self, directory):
+        files = []
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+    
+    def _remove_empty_dirs(self, directory, now):
+        for root, dirs, files in os.walk(directory, topdown=False):
+            if root != directory and not dirs and not files:
+                try:
+                    # A fresh directory may have been reserved by new_path() and not written yet
+                    if now - os.stat(root).st_mtime > self.max_age:
+                        os.rmdir(root)
+                except OSError:
+                    pass
+    
+    def sweep(self):
+        """
+        Enforce the age and size quota once.
+        
+        Returns:
+            dict: The updated metrics
+        """
+        now = time.time()
+        swept_files = 0
+        swept_bytes = 0
+        
+        for directory in [self.root] + self.extra_dirs:
+            if not os.path.isdir(directory):
+                continue
+            files = sorted(self._scan(directory))
+            total = sum(size for _, size, _ in files)
+            over_quota = directory == self.root
+            for mtime, size, path in files:
+                expired = now - mtime > self.max_age
+                if not expired and not (over_quota and total > self.max_bytes):
+                    continue
+                try:
+                    os.remove(path)
+                    swept_files += 1
+                    swept_bytes += size
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._remove_empty_dirs(directory, now)
+        
+        held = self._scan(self.root) if os.path.isdir(self.root) else []
+        sessions = len(os.listdir(self.root)) if os.path.isdir(self.root) else 0
+        with self._lock:
+            self._metrics["bytes_held"] = sum(size for _, size, _ in held)
+            self._metrics["files_held"] = len(held)
+            self._metrics["sessions"] = sessions
+            self._metrics["files_swept"] += swept_files
+            self._metrics["bytes_swept"] += swept_bytes
+            self._metrics["last_sweep"] = now
+            metrics = dict(self._metrics)
+        if swept_files:
+            logging.info(
+                f"Artifact sweep removed {swept_files} files ({swept_bytes} bytes), "
+                f"{metrics['bytes_held']} bytes in {metrics['files_held']} files remain"
+            )
+        return metrics
+    
+    def _run_sweeper(self):
+        # Sweep right away so the metrics describe what is on disk from the start
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping artifacts: {str(e)}")
+            if self._stop.wait(self.sweep_interval):
+                return
+    
+    def start_sweeper(self):
+        """Start the background sweeper thread, which sweeps once immediately, if it is not already running."""
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._run_sweeper, name="artifact-sweeper", daemon=True)
+            self._sweeper.start()
+    
+    def stop_sweeper(self):
+        """Stop the background sweeper thread."""
+        self._stop.set()
+    
+    def metrics(self) -> dict:
+        """
+        Report what the store holds, as of the last sweep.
+        
+        Returns:
+            dict: Bytes and files held, session count, and created/swept counters
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+# Shared store used by the app
+artifacts = ArtifactStore()
@@ -0,0 +1,128 @@
+import os
+import io
+import hashlib
+import logging
+from dataclasses import dataclass
+
+# Whisper works at 16 kHz mono; anything more is wasted upload
+AUDIO_SAMPLE_RATE = int(os.environ.get("AUDIO_SAMPLE_RATE", "16000"))
+AUDIO_UPLOAD_FORMAT = os.environ.get("AUDIO_UPLOAD_FORMAT", "mp3")
+AUDIO_UPLOAD_BITRATE = os.environ.get("AUDIO_UPLOAD_BITRATE", "48k")
+# Audio quieter than the recording's average loudness minus this many dB counts as silence
+AUDIO_SILENCE_OFFSET_DB = float(os.environ.get("AUDIO_SILENCE_OFFSET_DB", "16"))
+# Silence kept around the speech so word onsets are not clipped
+AUDIO_TRIM_PADDING_MS = int(os.environ.get("AUDIO_TRIM_PADDING_MS", "200"))
+# Recordings longer than this are split at pauses and transcribed in parallel
+AUDIO_MAX_CHUNK_SECONDS = float(os.environ.get("AUDIO_MAX_CHUNK_SECONDS", "60"))
+AUDIO_MIN_PAUSE_MS = int(os.environ.get("AUDIO_MIN_PAUSE_MS", "400"))
+
+@dataclass(frozen=True)
+class AudioChunk:
+    """One encoded piece of a recording, ready to upload."""
+    data: bytes
+    filename: str
+    duration_ms: int
+
+@dataclass(frozen=True)
+class PreparedAudio:
+    """A recording after trimming, resampling and encoding."""
+    chunks: list
+    sha256: str
+    original_bytes: int
+    
+    @property
+    def size(self):
+        return sum(len(chunk.data) for chunk in self.chunks)
+
+def _find_split_points(segment, silence_thresh, max_chunk_ms):
+    """
+    Choose cut points at pauses so no chunk is longer than max_chunk_ms.
+    
+    Args:
+        segment (AudioSegment): The trimmed recording
+        silence_thresh (float): dBFS level treated as silence
+        max_chunk_ms (int): Longest allowed chunk
+        
+    Returns:
+        list[int]: Cut positions in milliseconds, excluding 0 and the end
+    """
+    from pydub.silence import detect_silence
+    
+    pauses = detect_silence(segment, min_silence_len=AUDIO_MIN_PAUSE_MS, silence_thresh=silence_thresh, seek_step=10)
+    pause_midpoints = [(start + end) // 2 for start, end in pauses]
+    
+    cuts = []
+    chunk_start = 0
+    while len(segment) - chunk_start > max_chunk_ms:
+        limit = chunk_start + max_chunk_ms
+        # Prefer the last pause that keeps the chunk within the limit
+        candidates = [point for point in pause_midpoints if chunk_start < point <= limit]
+        cut = candidates[-1] if candidates else limit
+        cuts.append(cut)
+        chunk_start = cut
+    return cuts
+
+def _export(segment, name):
+    buffer = io.BytesIO()
+    try:
+        segment.export(buffer, format=AUDIO_UPLOAD_FORMAT, bitrate=AUDIO_UPLOAD_BITRATE)
+        return buffer.getvalue(), f"{name}.{AUDIO_UPLOAD_FORMAT}"
+    except Exception as e:
+        # Compressed formats need ffmpeg; 16 kHz mono WAV is still far smaller than the raw upload
+        logging.error(f"Error encoding audio as {AUDIO_UPLOAD_FORMAT}, falling back to WAV: {str(e)}")
+        buffer = io.BytesIO()
+        segment.export(buffer, format="wav")
+        return buffer.getvalue(), f"{name}.wav"
+
+def preprocess_audio(audio_filepath, max_chunk_seconds=None):
+    """
+    Trim, downmix, resample and compress a recording before transcription.
+    
+    Leading and trailing silence is removed with an energy threshold relative to
+    the recording's average loudness, the audio is converted to 16 kHz mono and
+    encoded compactly. Recordings longer than max_chunk_seconds are split at
+    pauses so the pieces can be transcribed in parallel.
+    
+    Args:
+        audio_filepath (str): Path to the recording
+        max_chunk_seconds (float): Longest chunk, defaults to AUDIO_MAX_CHUNK_SECONDS
+        
+    Returns:
+        PreparedAudio: The encoded chunks and a hash of their contents
+        
+    Raises:
+        FileNotFoundError: If the audio file doesn't exist
+    """
+    from pydub import AudioSegment
+    from pydub.silence import detect_leading_silence
+    
+    max_chunk_seconds = max_chunk_seconds or AUDIO_MAX_CHUNK_SECONDS
+    if not os.path.exists(audio_filepath):
+        raise FileNotFoundError(f"Audio file not found: {audio_filepath}")
+    
+    segment = AudioSegment.from_file(audio_filepath)
+    original_ms = len(segment)
+    segment = segment.set_channels(1).set_frame_rate(AUDIO_SAMPLE_RATE)
+    
+    silence_thresh = segment.dBFS - AUDIO_SILENCE_OFFSET_DB
+    start = detect_leading_silence(segment, silence_threshold=silence_thresh, chunk_size=10)
+    end = len(segment) - detect_leading_silence(segment.reverse(), silence_threshold=silence_thresh, chunk_size=10)
+    if end > start:
+        segment = segment[max(start - AUDIO_TRIM_PADDING_MS, 0):min(end + AUDIO_TRIM_PADDING_MS, len(segment))]
+    
+    cuts = _find_split_points(segment, silence_thresh, int(max_chunk_seconds * 1000))
+    bounds = [0] + cuts + [len(segment)]
+    
+    hasher = hashlib.sha256()
+    chunks = []
+    for i, (chunk_start, chunk_end) in enumerate(zip(bounds, bounds[1:])):
+        data, filename = _export(segment[chunk_start:chunk_end], f"chunk{i}")
+        hasher.update(data)
+        chunks.append(AudioChunk(data, filename, chunk_end - chunk_start))
+    
+    prepared = PreparedAudio(chunks, hasher.hexdigest(), os.path.getsize(audio_filepath))
+    logging.info(
+        f"Preprocessed {audio_filepath}: {original_ms} ms -> {len(segment)} ms in {len(chunks)} chunk(s), "
+        f"{prepared.original_bytes} -> {prepared.size} bytes"
+    )
+    return prepared
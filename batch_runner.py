@@ -0,0 +1,296 @@
+"""
+Run consultations offline from a JSON Lines file.
+
+Usage:
+    python batch_runner.py cases.jsonl [--output results.jsonl] [--output-dir batch_output]
+                           [--concurrency 8] [--no-speech] [--prescription]
+
+Each input line is one case:
+    {"id": "case-1", "patient_name": "Jane Doe", "audio": "question.mp3", "images": ["rash.jpg"]}
+    {"id": "case-2", "text": "Is this mole anything to worry about?", "images": "mole.jpg"}
+
+    id            Unique identifier copied to the result (defaults to "line-<n>");
+                  a later case reusing an id fails instead of overwriting the first
+    audio         Recording of the patient's question, transcribed first
+    text          The question as text (used instead of audio when both are given)
+    images        One image path or a list of them, analyzed together
+    patient_name  Name printed on the prescription (default "Patient")
+    speech        Synthesize the reply (overrides --no-speech for this case)
+    prescription  Render a prescription PDF (overrides --prescription for this case)
+
+Relative paths are resolved against the input file's directory. Generated
+audio and PDFs go to <output-dir>/<id>-<hash of the id>/. Results are
+appended to the output file as each case finishes, one JSON object per line,
+so an interrupted run can be restarted with the same arguments: cases that
+already have an "ok" result are skipped and failed ones are retried.
+
+Up to --concurrency cases are in flight at once and each stage (STT, vision,
+TTS, PDF) is bounded by the same STT_CONCURRENCY/VISION_CONCURRENCY/... limits
+as the web app, so throughput is set by what the providers accept rather than
+by processing cases one after another.
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import time
+import asyncio
+import logging
+import argparse
+
+from doctor import encode_image, analyze_image, prompt_builder
+from patient_voice import transcribe_audio
+from doctor_voice import text_to_speech
+from prescription import render_prescription
+from worker_pool import workers
+from admission import StageLimiter, STAGE_LIMITS
+import tracing
+
+def case_dir_name(case_id):
+    """
+    Directory name for a case's generated files.
+
+    The id is reduced to safe characters, which can make different ids look
+    alike ("a/b" and "a_b") or leave nothing (".."), so a short hash of the
+    raw id is always appended.
+
+    Args:
+        case_id (str): Identifier of the case
+
+    Returns:
+        str: A name unique to the id that cannot point outside the output directory
+    """
+    digest = hashlib.sha256(case_id.encode("utf-8")).hexdigest()[:10]
+    safe = re.sub(r"[^A-Za-z0-9._-]", "_", case_id).lstrip(".")[:64]
+    return f"{safe}-{digest}" if safe else digest
+
+def read_cases(input_path):
+    """
+    Parse the input file lazily.
+
+    Args:
+        input_path (str): Path to the JSON Lines file
+
+    Yields:
+        tuple[int, dict | None, str | None]: Line number, the parsed case (None if the line is
+            not a JSON object) and the parse error, if any
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                case = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, None, f"Invalid JSON: {str(e)}"
+                continue
+            if not isinstance(case, dict):
+                yield line_number, None, "Each line must be a JSON object"
+                continue
+            yield line_number, case, None
+
+def load_checkpoint(output_path):
+    """
+    Collect the ids of cases that already completed successfully.
+
+    Args:
+        output_path (str): Results file of a previous (possibly interrupted) run
+
+    Returns:
+        set[str]: Ids with an "ok" result
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run
+                continue
+            if isinstance(result, dict) and result.get("status") == "ok":
+                done.add(str(result.get("id")))
+    return done
+
+class BatchRunner:
+    """Process cases with bounded concurrency and append their results to a JSON Lines file."""
+
+    def __init__(self, output_path, output_dir, concurrency=8, speech=True, prescription=False, base_dir="."):
+        self.output_path = output_path
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.speech = speech
+        self.prescription = prescription
+        self.base_dir = base_dir
+        # Every in-flight case may wait on a stage, so the limiters never reject; they only bound concurrency
+        self.limiters = {
+            name: StageLimiter(name, stage_concurrency, max_queue=concurrency, max_wait=None)
+            for name, (stage_concurrency, _) in STAGE_LIMITS.items()
+        }
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def _resolve(self, path):
+        return path if os.path.isabs(path) else os.path.join(self.base_dir, path)
+
+    async def _stage(self, timings, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with self.limiters[name]:
+                return await asyncio.to_thread(func, *args, **kwargs)
+        finally:
+            timings[name] = round(timings.get(name, 0.0) + time.perf_counter() - start, 3)
+
+    async def process_case(self, case_id, case):
+        """
+        Run one case through transcription, image analysis, speech synthesis and prescription rendering.
+
+        Args:
+            case_id (str): Identifier of the case
+            case (dict): The parsed input record
+
+        Returns:
+            dict: The result record
+
+        Raises:
+            Exception: If any stage fails
+        """
+        timings = {}
+        result = {"id": case_id}
+
+        images = case.get("images") or []
+        if isinstance(images, str):
+            images = [images]
+
+        question = case.get("text")
+        if not question:
+            if not case.get("audio"):
+                raise ValueError("A case needs either 'text' or 'audio'")
+            question = await self._stage(timings, "stt", transcribe_audio, self._resolve(case["audio"]))
+            result["transcript"] = question
+
+        encode_start = time.perf_counter()
+        encoded_images = await asyncio.gather(
+            *(asyncio.to_thread(encode_image, self._resolve(path)) for path in images)
+        )
+        timings["encode_images"] = round(time.perf_counter() - encode_start, 3)
+
+        query = prompt_builder.build_question(question)
+        result["prompt_tokens"] = query.tokens
+        reply = await self._stage(timings, "vision", analyze_image, query, list(encoded_images) or None)
+        result["reply"] = reply
+
+        case_dir = os.path.join(self.output_dir, case_dir_name(case_id))
+        tasks = {}
+        if case.get("speech", self.speech):
+            os.makedirs(case_dir, exist_ok=True)
+            tasks["audio"] = self._stage(timings, "tts", text_to_speech, reply, os.path.join(case_dir, "doctor_response.mp3"))
+        if case.get("prescription", self.prescription):
+            os.makedirs(case_dir, exist_ok=True)
+            tasks["prescription"] = self._stage(
+                timings, "pdf", self._write_prescription, reply,
+                case.get("patient_name") or "Patient", os.path.join(case_dir, "prescription.pdf")
+            )
+        # Speech and the PDF only depend on the reply, so they run side by side
+        for key, path in zip(tasks, await asyncio.gather(*tasks.values())):
+            result[key] = path
+
+        result["timings"] = timings
+        return result
+
+    @staticmethod
+    def _write_prescription(reply, patient_name, path):
+        with open(path, "wb") as f:
+            f.write(workers.call(None, render_prescription, reply, patient_name))
+        return path
+
+    async def _run_one(self, case_id, line_number, case, error, output_file):
+        trace = tracing.start_trace("batch", case_id=case_id)
+        start = time.perf_counter()
+        try:
+            if error:
+                raise ValueError(error)
+            result = await self.process_case(case_id, case)
+            result["status"] = "ok"
+            self.succeeded += 1
+        except Exception as e:
+            logging.error(f"Case {case_id} failed: {str(e)}")
+            result = {"id": case_id, "status": "error", "error": str(e)}
+            self.failed += 1
+        result["line"] = line_number
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        tracing.finish_trace(trace, result["status"])
+
+        output_file.write(json.dumps(result) + "\n")
+        output_file.flush()
+
+    async def run(self, input_path):
+        """
+        Process every case in input_path that has no successful result yet.
+
+        Args:
+            input_path (str): Path to the JSON Lines input file
+
+        Returns:
+            dict: Counts of succeeded, failed and skipped cases
+        """
+        done = load_checkpoint(self.output_path)
+        cases = read_cases(input_path)
+        # First line of each id; a reused id would share the first case's files and checkpoint entry
+        first_lines = {}
+
+        with open(self.output_path, "a", encoding="utf-8") as output_file:
+            async def worker():
+                # Workers pull from the shared iterator, so the input is never read into memory at once
+                for line_number, case, error in cases:
+                    case_id = str(case.get("id") or f"line-{line_number}") if case else f"line-{line_number}"
+                    first_line = first_lines.setdefault(case_id, line_number)
+                    if first_line != line_number:
+                        await self._run_one(
+                            case_id, line_number, None, f"Duplicate case id, first used on line {first_line}", output_file
+                        )
+                        continue
+                    if case_id in done:
+                        self.skipped += 1
+                        continue
+                    await self._run_one(case_id, line_number, case, error, output_file)
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        return {"succeeded": self.succeeded, "failed": self.failed, "skipped": self.skipped}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSON Lines file of cases")
+    parser.add_argument("--output", help="Results file, appended to (default: <input>.results.jsonl)")
+    parser.add_argument("--output-dir", default="batch_output", help="Directory for generated audio and PDFs")
+    parser.add_argument("--concurrency", type=int, default=8, help="Cases processed at once")
+    parser.add_argument("--no-speech", action="store_true", help="Do not synthesize the replies")
+    parser.add_argument("--prescription", action="store_true", help="Render a prescription PDF for every case")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.splitext(args.input)[0] + ".results.jsonl"
+    runner = BatchRunner(
+        output_path,
+        args.output_dir,
+        concurrency=max(args.concurrency, 1),
+        speech=not args.no_speech,
+        prescription=args.prescription,
+        base_dir=os.path.dirname(os.path.abspath(args.input)),
+    )
+
+    start = time.perf_counter()
+    counts = asyncio.run(runner.run(args.input))
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Batch finished in {elapsed:.1f}s: {counts['succeeded']} succeeded, "
+        f"{counts['failed']} failed, {counts['skipped']} skipped. Results in {output_path}"
+    )
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
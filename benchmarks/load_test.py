@@ -0,0 +1,198 @@
+"""
+Replay recorded consultations through the app pipeline against mock model APIs.
+
+Usage:
+    python -m benchmarks.load_test [--requests 16] [--concurrency 1 4 16] [--latency 0.2] [--json]
+
+Starts benchmarks.mock_servers in-process (or uses --base-url to target an
+already running one), points the Groq and ElevenLabs clients at it and drives
+gradio_app.process_inputs with the repository's audio and image fixtures.
+Each request uses its own session, so nothing but the configured caches is
+shared between requests. Reports p50/p95/p99 of every stage recorded in the
+pipeline's stage timings (including the time to the first audio chunk) and
+the end to end latency seen by the caller, per concurrency level.
+
+Result caches are disabled unless --with-cache is given, so every request
+reaches the mock APIs. The gTTS fallback is removed from the TTS router to
+keep the run offline.
+"""
+import os
+import sys
+import json
+import logging
+import time
+import asyncio
+import argparse
+import statistics
+import contextvars
+from types import SimpleNamespace
+
+from benchmarks.mock_servers import REPO_ROOT, start_mock_server, add_behavior_arguments, config_from_args
+
+AUDIO_FIXTURES = ["patient_voice_test_for_patient.mp3"]
+IMAGE_FIXTURES = ["skin_rash.jpg", "image.jpg", "dandruff-optimized.webp"]
+
+# Timings dict of the request running in the current task, filled in by the stage timing observer
+_current_sample = contextvars.ContextVar("current_sample")
+
+def _record_stage_timings(stage_timings):
+    sample = _current_sample.get(None)
+    if sample is not None:
+        sample.update(stage_timings)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarize(samples):
+    """
+    Reduce per-request timings to percentiles.
+
+    Args:
+        samples (list[dict]): Stage name -> seconds, one dict per request
+
+    Returns:
+        dict: Stage name -> {"count", "p50", "p95", "p99", "mean"}
+    """
+    by_stage = {}
+    for sample in samples:
+        for stage, seconds in sample.items():
+            by_stage.setdefault(stage, []).append(seconds)
+    return {
+        stage: {
+            "count": len(values),
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "mean": statistics.fmean(values),
+        }
+        for stage, values in sorted(by_stage.items())
+    }
+
+def configure_environment(base_url, with_cache):
+    """Point the app at the mock APIs; must run before the app modules are imported."""
+    os.environ["GROQ_BASE_URL"] = base_url
+    os.environ["ELEVENLABS_BASE_URL"] = base_url
+    os.environ.setdefault("GROQ_API_KEY", "mock-groq-key")
+    os.environ.setdefault("ELEVENLABS_API_KEY", "mock-elevenlabs-key")
+    # The harness is the only client, so per-session rate limits would only skew the numbers
+    os.environ["RATE_LIMIT_PER_MINUTE"] = "100000"
+    os.environ["RATE_LIMIT_BURST"] = "100000"
+    os.environ["LOCAL_PLAYBACK"] = "false"
+    if not with_cache:
+        os.environ["CACHE_MEMORY_ENTRIES"] = "0"
+        os.environ["CACHE_DIR"] = ""
+        os.environ["CACHE_SHARED"] = "false"
+
+async def run_request(app, index, audio_path, image_paths, timings, errors):
+    """Drive one consultation turn to completion and record its timings."""
+    request = SimpleNamespace(session_hash=f"loadtest-{index}", client=None, headers={})
+    sample = {}
+    _current_sample.set(sample)
+    start = time.perf_counter()
+    status = None
+    async for update in app.process_inputs(audio_path, image_paths, [], "Load Test", request):
+        status = update[4]
+    sample["end_to_end"] = time.perf_counter() - start
+    timings.append(sample)
+    if isinstance(status, str) and any(word in status.lower() for word in ("error", "busy", "too long")):
+        errors.append(status)
+
+async def run_level(app, concurrency, total_requests):
+    """
+    Run total_requests consultations with at most concurrency in flight.
+
+    Returns:
+        tuple[list[dict], list[str], float]: Per-request timings, error statuses, wall time
+    """
+    samples = []
+    errors = []
+    app.stage_timing_observers.append(_record_stage_timings)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(index):
+        audio_path = os.path.join(REPO_ROOT, AUDIO_FIXTURES[index % len(AUDIO_FIXTURES)])
+        image_paths = [os.path.join(REPO_ROOT, IMAGE_FIXTURES[index % len(IMAGE_FIXTURES)])]
+        async with semaphore:
+            await run_request(app, index, audio_path, image_paths, samples, errors)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(bounded(i) for i in range(total_requests)))
+    finally:
+        app.stage_timing_observers.remove(_record_stage_timings)
+    wall = time.perf_counter() - start
+    return samples, errors, wall
+
+def print_report(concurrency, summary, errors, wall, total_requests, request_counts):
+    print(f"\nconcurrency={concurrency} requests={total_requests} wall={wall:.2f}s "
+          f"throughput={total_requests / wall:.2f} req/s errors={len(errors)}")
+    print(f"  {'stage':<24}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, stats in summary.items():
+        print(f"  {stage:<24}{stats['count']:>7}{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}")
+    if request_counts:
+        print("  upstream calls: " + ", ".join(f"{path}={count}" for path, count in sorted(request_counts.items())))
+    for error in sorted(set(errors)):
+        print(f"  error: {error}")
+
+async def run_levels(app, args, server, results):
+    """Run every requested concurrency level in turn, appending one result dict per level."""
+    for concurrency in args.concurrency:
+        if server is not None:
+            server.request_counts.clear()
+        samples, errors, wall = await run_level(app, concurrency, args.requests)
+        summary = summarize(samples)
+        request_counts = dict(server.request_counts) if server is not None else {}
+        results.append({
+            "concurrency": concurrency,
+            "requests": args.requests,
+            "wall_seconds": wall,
+            "throughput": args.requests / wall,
+            "errors": errors,
+            "upstream_calls": request_counts,
+            "stages": summary,
+        })
+        if not args.json:
+            print_report(concurrency, summary, errors, wall, args.requests, request_counts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=16, help="Consultations per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrency levels to run")
+    parser.add_argument("--base-url", help="Use an already running mock server instead of starting one")
+    parser.add_argument("--with-cache", action="store_true", help="Keep the result caches enabled")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's INFO logging")
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = start_mock_server(config_from_args(args))
+        base_url = server.base_url
+    configure_environment(base_url, args.with_cache)
+
+    sys.path.insert(0, REPO_ROOT)
+    import gradio_app
+    import doctor_voice
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    doctor_voice.tts_router.providers = [
+        (name, func) for name, func in doctor_voice.tts_router.providers if name != "gtts"
+    ]
+
+    # All levels share one event loop, since the app's stage limiters bind to the loop they first wait on
+    results = []
+    try:
+        asyncio.run(run_levels(gradio_app, args, server, results))
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
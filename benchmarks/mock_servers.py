@@ -0,0 +1,244 @@
+"""
+Local stand-ins for the Groq and ElevenLabs HTTP APIs.
+
+Usage:
+    python -m benchmarks.mock_servers [--port 8900] [--latency 0.2] [--error-rate 0.05]
+
+Point the app at it with GROQ_BASE_URL and ELEVENLABS_BASE_URL, e.g.
+    GROQ_BASE_URL=http://127.0.0.1:8900 ELEVENLABS_BASE_URL=http://127.0.0.1:8900
+
+Served endpoints:
+    POST /openai/v1/chat/completions         (plain and stream=true server-sent events)
+    POST /openai/v1/audio/transcriptions
+    GET  /v1/voices
+    POST /v1/text-to-speech/<voice_id>[/stream]
+
+Each endpoint waits for a configurable latency (with jitter) and fails a
+configurable fraction of requests with 500 or 429 responses.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MOCK_REPLY = (
+    "The image shows a red, slightly raised rash with some dry patches. This looks most consistent "
+    "with a mild irritant or allergic dermatitis. Keep the area clean and dry and avoid scratching. "
+    "A fragrance-free moisturizer and an over-the-counter hydrocortisone cream can help. "
+    "If it spreads, blisters or does not improve within a week, please see a healthcare professional."
+)
+MOCK_TRANSCRIPT = "I have had an itchy red rash on my arm for a few days. What could it be?"
+MOCK_VOICE_ID = "mockvoice000000000000"
+
+@dataclass
+class EndpointBehavior:
+    """Latency and failure injection for one endpoint."""
+    latency: float = 0.2
+    jitter: float = 0.05
+    error_rate: float = 0.0
+    # Delay between streamed chunks (chat streaming only)
+    chunk_delay: float = 0.01
+
+@dataclass
+class MockConfig:
+    chat: EndpointBehavior = field(default_factory=EndpointBehavior)
+    transcription: EndpointBehavior = field(default_factory=EndpointBehavior)
+    tts: EndpointBehavior = field(default_factory=EndpointBehavior)
+    reply: str = MOCK_REPLY
+    transcript: str = MOCK_TRANSCRIPT
+    audio_fixture: str = os.path.join(REPO_ROOT, "elevenlabs_testing_autoplay.mp3")
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockModelAPI/1.0"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    @property
+    def config(self):
+        return self.server.config
+    
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+    
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload).encode("utf-8"), headers=headers)
+    
+    def _simulate(self, behavior):
+        """Sleep for the configured latency; return False if this request should fail."""
+        time.sleep(max(0.0, random.gauss(behavior.latency, behavior.jitter)))
+        if random.random() < behavior.error_rate:
+            if random.random() < 0.5:
+                self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}}, {"Retry-After": "1"})
+            else:
+                self._send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return False
+        return True
+    
+    def do_GET(self):
+        self.server.count(self.path)
+        if self.path.split("?")[0] == "/v1/voices":
+            self._send_json(200, {"voices": [{"voice_id": MOCK_VOICE_ID, "name": "Aria", "category": "premade"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+    
+    def do_POST(self):
+        self.server.count(self.path)
+        path = self.path.split("?")[0]
+        body = self._read_body()
+        if path == "/openai/v1/chat/completions":
+            self._chat(json.loads(body or b"{}"))
+        elif path == "/openai/v1/audio/transcriptions":
+            if self._simulate(self.config.transcription):
+                self._send_json(200, {"text": self.config.transcript})
+        elif path.startswith("/v1/text-to-speech/"):
+            if self._simulate(self.config.tts):
+                with open(self.config.audio_fixture, "rb") as f:
+                    self._send(200, f.read(), content_type="audio/mpeg")
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+    
+    def _chat(self, request):
+        behavior = self.config.chat
+        if not self._simulate(behavior):
+            return
+        model = request.get("model", "mock-model")
+        created = int(time.time())
+        words = self.config.reply.split(" ")
+        prompt_tokens = sum(len(json.dumps(m)) for m in request.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+        
+        if not request.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.config.reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        
+        def write_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        
+        for i, word in enumerate(words):
+            time.sleep(behavior.chunk_delay)
+            write_event(json.dumps({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+            }))
+        write_event(json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "x_groq": {"usage": usage},
+        }))
+        write_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class MockAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, address, config=None):
+        super().__init__(address, MockAPIHandler)
+        self.config = config or MockConfig()
+        self.request_counts = {}
+        self._count_lock = threading.Lock()
+    
+    def count(self, path):
+        key = path.split("?")[0]
+        with self._count_lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+    
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """
+    Start the mock API server on a background thread.
+    
+    Args:
+        config (MockConfig): Latency and error injection settings
+        host (str): Interface to bind
+        port (int): Port to bind, 0 picks a free one
+        
+    Returns:
+        MockAPIServer: The running server; call shutdown() to stop it
+    """
+    server = MockAPIServer((host, port), config)
+    threading.Thread(target=server.serve_forever, name="mock-api", daemon=True).start()
+    return server
+
+def add_behavior_arguments(parser):
+    """Add the latency/error-injection options shared by the mock server and load test CLIs."""
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean latency of every endpoint (seconds)")
+    parser.add_argument("--chat-latency", type=float, help="Override latency of chat completions")
+    parser.add_argument("--stt-latency", type=float, help="Override latency of transcriptions")
+    parser.add_argument("--tts-latency", type=float, help="Override latency of text-to-speech")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 429/500")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="Delay between streamed chat chunks")
+
+def config_from_args(args):
+    def behavior(latency):
+        return EndpointBehavior(
+            latency=args.latency if latency is None else latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            chunk_delay=args.chunk_delay,
+        )
+    return MockConfig(
+        chat=behavior(args.chat_latency),
+        transcription=behavior(args.stt_latency),
+        tts=behavior(args.tts_latency),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+    
+    server = MockAPIServer((args.host, args.port), config_from_args(args))
+    print(f"Mock Groq/ElevenLabs API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Measure how long each application module takes to import in a fresh interpreter.
+
+Usage:
+    python -m benchmarks.startup [--runs N] [module ...]
+
+Each module is imported in a new process (so nothing is already cached in
+sys.modules) with API keys removed from the environment, to check that
+importing never blocks on hardware or fails on missing credentials (a local
+.env file can still supply them). The report also lists heavy optional
+dependencies that were pulled in eagerly; note that gradio itself imports
+pydub, so gradio_app always shows it.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = ["doctor", "patient_voice", "doctor_voice", "gradio_app"]
+
+# Dependencies that should only be imported when first used
+LAZY_MODULES = ["speech_recognition", "pydub", "elevenlabs", "reportlab", "gtts", "groq"]
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+def measure_import(module, runs):
+    """
+    Import a module in fresh interpreters and collect timings.
+    
+    Args:
+        module (str): Name of the module to import
+        runs (int): Number of fresh processes to time
+        
+    Returns:
+        dict: Median and max import seconds, and eagerly loaded heavy dependencies
+    """
+    env = {k: v for k, v in os.environ.items() if k not in ("GROQ_API_KEY", "ELEVENLABS_API_KEY")}
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, lazy=LAZY_MODULES)],
+            cwd=REPO_ROOT,
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(sample["seconds"])
+        loaded = sample["loaded"]
+    return {"median": statistics.median(timings), "max": max(timings), "eager": loaded}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    
+    print(f"{'module':<16}{'median':>10}{'max':>10}  eager heavy imports")
+    for module in args.modules:
+        stats = measure_import(module, args.runs)
+        print(f"{module:<16}{stats['median']:>9.3f}s{stats['max']:>9.3f}s  {', '.join(stats['eager']) or '-'}")
+
+if __name__ == "__main__":
+    main()
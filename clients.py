@@ -0,0 +1,133 @@
+import os
+import threading
+import logging
+import httpx
+from dotenv import load_dotenv
+load_dotenv()
+
+# Connection pool settings shared by every outbound HTTP client
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "60"))
+
+# Point these at a local fake server to run without the real APIs
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL")
+ELEVENLABS_BASE_URL = os.environ.get("ELEVENLABS_BASE_URL")
+
+_clients = {}
+_lock = threading.Lock()
+
+def _build_http_client():
+    """
+    Build an httpx client with the configured connection pool and timeouts.
+    
+    Returns:
+        httpx.Client: A keep-alive HTTP client
+    """
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+def _get_or_create(key, factory):
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory()
+            _clients[key] = client
+            logging.info(f"Created shared {key[0]} client")
+        return client
+
+def get_groq_client(api_key=None):
+    """
+    Return the process-wide Groq client for an API key, creating it on first use.
+    
+    Args:
+        api_key (str): Groq API key, defaults to the GROQ_API_KEY environment variable
+        
+    Returns:
+        Groq: A client whose connection pool is reused across requests
+        
+    Raises:
+        ValueError: If no API key is available
+    """
+    api_key = api_key or os.environ.get("GROQ_API_KEY")
+    if not api_key:
+        raise ValueError("GROQ_API_KEY environment variable is not set")
+    
+    def factory():
+        from groq import Groq
+        return Groq(
+            api_key=api_key,
+            base_url=GROQ_BASE_URL,
+            timeout=HTTP_TIMEOUT,
+            # Retries are done by deadlines.call_with_retry, which knows the request's deadline
+            max_retries=0,
+            http_client=_build_http_client(),
+        )
+    
+    return _get_or_create(("groq", api_key), factory)
+
+def get_elevenlabs_client(api_key=None):
+    """
+    Return the process-wide ElevenLabs client for an API key, creating it on first use.
+    
+    Args:
+        api_key (str): ElevenLabs API key, defaults to the ELEVENLABS_API_KEY environment variable
+        
+    Returns:
+        ElevenLabs: A client whose connection pool is reused across requests
+        
+    Raises:
+        ValueError: If no API key is available
+    """
+    api_key = api_key or os.environ.get("ELEVENLABS_API_KEY")
+    if not api_key:
+        raise ValueError("ELEVENLABS_API_KEY environment variable is not set")
+    
+    def factory():
+        from elevenlabs.client import ElevenLabs
+        return ElevenLabs(
+            api_key=api_key,
+            base_url=ELEVENLABS_BASE_URL,
+            timeout=HTTP_TIMEOUT,
+            httpx_client=_build_http_client(),
+        )
+    
+    return _get_or_create(("elevenlabs", api_key), factory)
+
+def register_client(provider, client, api_key=None):
+    """
+    Install a client for a provider, e.g. a fake pointed at a local test server.
+    
+    Args:
+        provider (str): "groq" or "elevenlabs"
+        client: The client object to hand out from the registry
+        api_key (str): API key the client is registered under, defaults to the
+            provider's environment variable
+    """
+    api_key = api_key or os.environ.get(f"{provider.upper()}_API_KEY")
+    with _lock:
+        _clients[(provider, api_key)] = client
+
+def reset_clients():
+    """Close and forget every registered client so the next call creates fresh ones."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        try:
+            close = getattr(client, "close", None)
+            if close is not None:
+                close()
+        except Exception as e:
+            logging.error(f"Error closing client: {str(e)}")
@@ -0,0 +1,580 @@
+"""
+Durable log of consultations in SQLite, with recordings, images and generated files
+stored once per content hash next to the database.
+
+Usage:
+    python consultation_log.py list [--patient NAME] [--session ID] [--since ISO] [--until ISO] [--limit N] [--cursor C]
+    python consultation_log.py show ID
+    python consultation_log.py import-flagged .gradio/flagged/dataset1.csv
+"""
+import os
+import csv
+import atexit
+import sys
+import json
+import time
+import queue
+import shutil
+import sqlite3
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+# Off unless enabled: the log keeps patient recordings and images on disk
+CONSULTATION_LOG_ENABLED = os.environ.get("CONSULTATION_LOG_ENABLED", "false").lower() in ("1", "true", "yes")
+# Holds consultations.db and the blobs/ directory; next to this module unless configured,
+# so it does not depend on the working directory
+CONSULTATION_LOG_DIR = os.path.abspath(os.environ.get(
+    "CONSULTATION_LOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "consultation_log")
+))
+# Retention: consultations older than this many seconds are deleted (0 keeps them),
+# then the oldest ones while their stored files exceed the byte limit (0 for no limit)
+CONSULTATION_LOG_MAX_AGE = float(os.environ.get("CONSULTATION_LOG_MAX_AGE", str(30 * 24 * 3600)))
+CONSULTATION_LOG_MAX_BYTES = int(os.environ.get("CONSULTATION_LOG_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+CONSULTATION_LOG_PRUNE_INTERVAL = float(os.environ.get("CONSULTATION_LOG_PRUNE_INTERVAL", "3600"))
+# Consultations deleted per retention batch; the writer stores waiting records between batches
+CONSULTATION_LOG_PRUNE_BATCH = int(os.environ.get("CONSULTATION_LOG_PRUNE_BATCH", "200"))
+# Records written per transaction, and how long the writer waits to fill a batch
+CONSULTATION_LOG_BATCH_SIZE = int(os.environ.get("CONSULTATION_LOG_BATCH_SIZE", "100"))
+CONSULTATION_LOG_FLUSH_INTERVAL = float(os.environ.get("CONSULTATION_LOG_FLUSH_INTERVAL", "0.5"))
+# Records waiting to be written before new ones are dropped (with an error logged)
+CONSULTATION_LOG_MAX_PENDING = int(os.environ.get("CONSULTATION_LOG_MAX_PENDING", "10000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS consultations (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    session_id TEXT,
+    patient_name TEXT,
+    patient_key TEXT,
+    transcript TEXT,
+    response TEXT,
+    status TEXT,
+    stage_timings TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_consultations_created ON consultations (created_at, id);
+CREATE INDEX IF NOT EXISTS idx_consultations_patient ON consultations (patient_key, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_consultations_session ON consultations (session_id, created_at, id);
+
+CREATE TABLE IF NOT EXISTS artifacts (
+    consultation_id INTEGER NOT NULL REFERENCES consultations (id),
+    kind TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    filename TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_consultation ON artifacts (consultation_id);
+CREATE INDEX IF NOT EXISTS idx_artifacts_sha256 ON artifacts (sha256);
+"""
+
+# Columns returned when paging; the full response text is only loaded by get()
+_SUMMARY_COLUMNS = "id, created_at, session_id, patient_name, transcript, substr(response, 1, 200) AS response_preview, status"
+
+def _patient_key(patient_name):
+    return " ".join(patient_name.split()).casefold() if patient_name else None
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    # WAL with synchronous=NORMAL is durable across application crashes and much faster than FULL
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+class BlobStore:
+    """Files stored once under their SHA-256, in a two-level fan-out directory."""
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+    
+    def put_file(self, source_path):
+        """
+        Copy a file into the store unless identical content is already there.
+        
+        Args:
+            source_path (str): File to store
+        
+        Returns:
+            tuple[str, int]: SHA-256 hex digest and size in bytes
+        """
+        digest = hashlib.sha256()
+        with open(source_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+        size = os.path.getsize(source_path)
+        
+        target = self.path(sha256)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Copy under a temporary name first so a crash never leaves a truncated blob
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+            os.close(fd)
+            try:
+                shutil.copyfile(source_path, temp_path)
+                os.replace(temp_path, target)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return sha256, size
+
+class ConsultationLog:
+    """
+    Append-only consultation log backed by SQLite in WAL mode.
+    
+    record() only puts the consultation on a queue; a background thread hashes
+    and copies its files into the blob store and inserts records in batches,
+    one transaction per batch. Reads use a separate connection per thread and
+    page with keyset cursors, so lookups stay index-bound however large the
+    log grows. The same thread applies the retention limits every
+    prune_interval seconds (see prune()), in batches interleaved with
+    record batches.
+    """
+    
+    def __init__(self, root=CONSULTATION_LOG_DIR, batch_size=CONSULTATION_LOG_BATCH_SIZE,
+                 flush_interval=CONSULTATION_LOG_FLUSH_INTERVAL, max_pending=CONSULTATION_LOG_MAX_PENDING,
+                 max_age=CONSULTATION_LOG_MAX_AGE, max_bytes=CONSULTATION_LOG_MAX_BYTES,
+                 prune_interval=CONSULTATION_LOG_PRUNE_INTERVAL, prune_batch=CONSULTATION_LOG_PRUNE_BATCH):
+        self.root = root
+        self.db_path = os.path.join(root, "consultations.db")
+        self.blobs = BlobStore(os.path.join(root, "blobs"))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self.prune_batch = max(prune_batch, 1)
+        self._next_prune = 0.0
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._initialized = False
+        self.written = 0
+        self.dropped = 0
+        self.pruned = 0
+    
+    def _initialize(self):
+        with self._lock:
+            if self._initialized:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            connection = _connect(self.db_path)
+            try:
+                connection.executescript(_SCHEMA)
+            finally:
+                connection.close()
+            self._initialized = True
+    
+    def _reader(self):
+        self._initialize()
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = _connect(self.db_path)
+        return connection
+    
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                if self._writer is None:
+                    # Write out what is still queued when the interpreter exits
+                    atexit.register(self.flush)
+                self._writer = threading.Thread(target=self._write_loop, name="consultation-log", daemon=True)
+                self._writer.start()
+    
+    def record(self, session_id, patient_name, transcript, response, status="ok",
+               stage_timings=None, files=None, created_at=None):
+        """
+        Queue a consultation for writing. Never blocks the caller.
+        
+        Args:
+            session_id (str): Browser session the consultation belongs to
+            patient_name (str): Name the patient entered
+            transcript (str): What the patient said
+            response (str): The doctor's reply
+            status (str): Outcome, e.g. "ok", "error", "rejected"
+            stage_timings (dict): Seconds per pipeline stage
+            files (list[tuple[str, str]]): (kind, path) pairs, e.g. ("image", "/tmp/rash.jpg");
+                missing paths are skipped
+            created_at (float): Unix timestamp, defaults to now
+        
+        Returns:
+            bool: False if the write queue was full and the record was dropped
+        """
+        item = {
+            "created_at": created_at if created_at is not None else time.time(),
+            "session_id": session_id,
+            "patient_name": patient_name or None,
+            "transcript": transcript,
+            "response": response,
+            "status": status,
+            "stage_timings": json.dumps(stage_timings) if stage_timings else None,
+            "files": [(kind, path) for kind, path in (files or []) if path],
+        }
+        try:
+            self._pending.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            logging.error("Consultation log queue is full, dropping a record")
+            return False
+        self._start_writer()
+        return True
+    
+    def _next_batch(self, block=True):
+        try:
+            batch = [self._pending.get(block=block)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _write_loop(self):
+        self._initialize()
+        connection = _connect(self.db_path)
+        pruning = None
+        while True:
+            # While a prune pass is under way, only take records already waiting, then run its next batch
+            batch = self._next_batch(block=pruning is None)
+            if batch:
+                try:
+                    self._write_batch(connection, batch)
+                except Exception as e:
+                    logging.error(f"Error writing {len(batch)} consultation(s) to the log: {str(e)}")
+                finally:
+                    for _ in batch:
+                        self._pending.task_done()
+            if pruning is None and time.monotonic() >= self._next_prune:
+                self._next_prune = time.monotonic() + self.prune_interval
+                pruning = self._prune_batches(connection)
+            if pruning is not None:
+                try:
+                    next(pruning)
+                except StopIteration:
+                    pruning = None
+                except Exception as e:
+                    logging.error(f"Error pruning the consultation log: {str(e)}")
+                    pruning = None
+    
+    def _write_batch(self, connection, batch):
+        # Hash and copy files before opening the transaction, so it stays short
+        artifacts = []
+        for item in batch:
+            stored = []
+            for kind, path in item["files"]:
+                try:
+                    sha256, size = self.blobs.put_file(path)
+                    stored.append((kind, sha256, os.path.basename(path), size))
+                except OSError as e:
+                    logging.error(f"Error storing {kind} for the consultation log: {str(e)}")
+            artifacts.append(stored)
+        
+        with connection:
+            for item, stored in zip(batch, artifacts):
+                cursor = connection.execute(
+                    "INSERT INTO consultations (created_at, session_id, patient_name, patient_key, transcript, response, status, stage_timings) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (item["created_at"], item["session_id"], item["patient_name"], _patient_key(item["patient_name"]),
+                     item["transcript"], item["response"], item["status"], item["stage_timings"])
+                )
+                connection.executemany(
+                    "INSERT INTO artifacts (consultation_id, kind, sha256, filename, size) VALUES (?, ?, ?, ?, ?)",
+                    [(cursor.lastrowid, *artifact) for artifact in stored]
+                )
+        self.written += len(batch)
+    
+    def _delete(self, connection, consultation_ids):
+        """
+        Delete consultations and the blobs only they referenced.
+        
+        Returns:
+            tuple[int, int, int]: Consultations deleted, bytes of blobs freed and blob files removed
+        """
+        marks = ",".join("?" * len(consultation_ids))
+        with connection:
+            sizes = dict(connection.execute(
+                f"SELECT sha256, MAX(size) FROM artifacts WHERE consultation_id IN ({marks}) GROUP BY sha256",
+                consultation_ids
+            ).fetchall())
+            connection.execute(f"DELETE FROM artifacts WHERE consultation_id IN ({marks})", consultation_ids)
+            connection.execute(f"DELETE FROM consultations WHERE id IN ({marks})", consultation_ids)
+            # Only the hashes these consultations used can have become unreferenced
+            hashes = list(sizes)
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                for (sha256,) in connection.execute(
+                    f"SELECT DISTINCT sha256 FROM artifacts WHERE sha256 IN ({','.join('?' * len(chunk))})", chunk
+                ):
+                    del sizes[sha256]
+        
+        removed = 0
+        for sha256 in sizes:
+            try:
+                os.remove(self.blobs.path(sha256))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return len(consultation_ids), sum(size or 0 for size in sizes.values()), removed
+    
+    def _stored_bytes(self, connection):
+        return connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM artifacts GROUP BY sha256)"
+        ).fetchone()[0]
+    
+    def _prune_batches(self, connection):
+        """Apply the retention limits, yielding after each batch of at most prune_batch consultations."""
+        deleted = removed = 0
+        
+        def delete(consultation_ids):
+            nonlocal deleted, removed
+            count, freed, files = self._delete(connection, consultation_ids)
+            deleted += count
+            removed += files
+            self.pruned += count
+            return freed
+        
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            while True:
+                expired = [row[0] for row in connection.execute(
+                    "SELECT id FROM consultations WHERE created_at < ? ORDER BY created_at, id LIMIT ?",
+                    (cutoff, self.prune_batch)
+                )]
+                if not expired:
+                    break
+                delete(expired)
+                yield
+        
+        if self.max_bytes:
+            # One full count per pass; after that each batch subtracts the bytes it freed
+            excess = self._stored_bytes(connection) - self.max_bytes
+            while excess > 0:
+                # Oldest first, until their files add up to the excess; shared files free
+                # nothing while still referenced, so another batch may be needed
+                oldest, total = [], 0
+                for consultation_id, size in connection.execute(
+                    "SELECT c.id, COALESCE(SUM(a.size), 0) "
+                    "FROM (SELECT id, created_at FROM consultations ORDER BY created_at, id LIMIT ?) c "
+                    "LEFT JOIN artifacts a ON a.consultation_id = c.id "
+                    "GROUP BY c.id ORDER BY c.created_at, c.id",
+                    (self.prune_batch,)
+                ):
+                    oldest.append(consultation_id)
+                    total += size
+                    if total >= excess:
+                        break
+                if not oldest:
+                    break
+                excess -= delete(oldest)
+                yield
+        
+        if deleted or removed:
+            logging.info(f"Consultation log retention deleted {deleted} consultation(s) and {removed} file(s)")
+        return deleted
+    
+    def prune(self, connection=None):
+        """
+        Apply the retention limits once.
+        
+        Deletes consultations older than max_age, then the oldest remaining
+        ones while their stored files take more than max_bytes, removing each
+        blob once no consultation references it. The writer thread runs the
+        same pass a batch at a time, so no blob is being stored while
+        unreferenced ones are removed.
+        
+        Args:
+            connection (sqlite3.Connection): Connection to use, defaults to a new one
+        
+        Returns:
+            int: Number of consultations deleted
+        """
+        self._initialize()
+        own_connection = connection is None
+        connection = connection or _connect(self.db_path)
+        try:
+            batches = self._prune_batches(connection)
+            while True:
+                try:
+                    next(batches)
+                except StopIteration as done:
+                    return done.value
+        finally:
+            if own_connection:
+                connection.close()
+    
+    def flush(self):
+        """Block until every queued record has been written."""
+        if self._writer is not None:
+            self._pending.join()
+    
+    def query(self, patient_name=None, session_id=None, since=None, until=None, limit=50, cursor=None):
+        """
+        Page through consultations, newest first.
+        
+        Args:
+            patient_name (str): Only this patient (case and whitespace insensitive)
+            session_id (str): Only this session
+            since (float): Only consultations at or after this Unix timestamp
+            until (float): Only consultations before this Unix timestamp
+            limit (int): Page size (at most 500)
+            cursor (str): next_cursor from the previous page
+        
+        Returns:
+            dict: {"items": [...], "next_cursor": str | None}; items carry a 200 character
+                response preview, use get() for the full record
+        """
+        conditions, params = [], []
+        if patient_name:
+            conditions.append("patient_key = ?")
+            params.append(_patient_key(patient_name))
+        if session_id:
+            conditions.append("session_id = ?")
+            params.append(session_id)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(until)
+        if cursor:
+            cursor_time, cursor_id = cursor.rsplit(":", 1)
+            conditions.append("(created_at < ? OR (created_at = ? AND id < ?))")
+            params.extend([float(cursor_time), float(cursor_time), int(cursor_id)])
+        
+        limit = max(1, min(int(limit), 500))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._reader().execute(
+            f"SELECT {_SUMMARY_COLUMNS} FROM consultations {where} ORDER BY created_at DESC, id DESC LIMIT ?",
+            (*params, limit + 1)
+        ).fetchall()
+        
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = f"{last['created_at']!r}:{last['id']}"
+        return {"items": items, "next_cursor": next_cursor}
+    
+    def get(self, consultation_id):
+        """
+        Load one consultation with its stored files.
+        
+        Args:
+            consultation_id (int): Id from query()
+        
+        Returns:
+            dict | None: The consultation, with "artifacts" giving each file's kind, hash and blob path
+        """
+        connection = self._reader()
+        row = connection.execute("SELECT * FROM consultations WHERE id = ?", (consultation_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record.pop("patient_key", None)
+        record["stage_timings"] = json.loads(record["stage_timings"]) if record["stage_timings"] else None
+        record["artifacts"] = [
+            dict(artifact, path=self.blobs.path(artifact["sha256"]))
+            for artifact in connection.execute(
+                "SELECT kind, sha256, filename, size FROM artifacts WHERE consultation_id = ?", (consultation_id,)
+            ).fetchall()
+        ]
+        return record
+    
+    def import_flagged_csv(self, csv_path):
+        """
+        Import rows from a Gradio flagging CSV (e.g. .gradio/flagged/dataset1.csv).
+        
+        File paths in the CSV are relative to the directory containing .gradio
+        and may use Windows separators.
+        
+        Args:
+            csv_path (str): Path to the CSV file
+        
+        Returns:
+            int: Number of rows queued
+        """
+        base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(csv_path))))
+        
+        def resolve(value):
+            if not value:
+                return None
+            path = os.path.join(base_dir, value.strip().replace("\\", os.sep))
+            return path if os.path.exists(path) else None
+        
+        count = 0
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            # Header: the component labels, then "timestamp"
+            next(reader, None)
+            for row in reader:
+                if len(row) < 7:
+                    continue
+                audio, image, transcript, response, response_audio, status, timestamp = row[:7]
+                self.record(
+                    session_id=None,
+                    patient_name=None,
+                    transcript=transcript.strip(),
+                    response=response,
+                    status="error" if status else "ok",
+                    files=[("audio_input", resolve(audio)), ("image", resolve(image)), ("response_audio", resolve(response_audio))],
+                    created_at=datetime.fromisoformat(timestamp).timestamp(),
+                )
+                count += 1
+        return count
+
+consultation_log = ConsultationLog()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="Page through consultations, newest first")
+    list_parser.add_argument("--patient")
+    list_parser.add_argument("--session")
+    list_parser.add_argument("--since", help="ISO date or time, e.g. 2025-04-01")
+    list_parser.add_argument("--until", help="ISO date or time")
+    list_parser.add_argument("--limit", type=int, default=20)
+    list_parser.add_argument("--cursor", help="next_cursor printed by the previous page")
+    show_parser = commands.add_parser("show", help="Print one consultation with its files")
+    show_parser.add_argument("id", type=int)
+    import_parser = commands.add_parser("import-flagged", help="Import a Gradio flagging CSV")
+    import_parser.add_argument("csv_path")
+    args = parser.parse_args()
+    
+    if args.command == "list":
+        page = consultation_log.query(
+            patient_name=args.patient,
+            session_id=args.session,
+            since=datetime.fromisoformat(args.since).timestamp() if args.since else None,
+            until=datetime.fromisoformat(args.until).timestamp() if args.until else None,
+            limit=args.limit,
+            cursor=args.cursor,
+        )
+        print(json.dumps(page, indent=2))
+    elif args.command == "show":
+        record = consultation_log.get(args.id)
+        if record is None:
+            print(f"No consultation with id {args.id}", file=sys.stderr)
+            return 1
+        print(json.dumps(record, indent=2))
+    else:
+        count = consultation_log.import_flagged_csv(args.csv_path)
+        consultation_log.flush()
+        print(f"Imported {count} consultation(s) into {consultation_log.db_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+import os
+import time
+import random
+import logging
+import contextvars
+import email.utils
+from contextlib import contextmanager
+import httpx
+from clients import HTTP_TIMEOUT
+import tracing
+
+# End-to-end budget (seconds) of one consultation turn; 0 disables the deadline
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "90"))
+# How the remaining time is split between the stages, in pipeline order. A stage
+# gets its share of what is left relative to itself and the stages after it, so
+# time saved by a fast stage goes to the later ones
+DEADLINE_STAGE_SHARES = [
+    (name, float(share))
+    for name, share in (
+        part.split(":") for part in os.environ.get("DEADLINE_STAGE_SHARES", "stt:0.25,vision:0.45,tts:0.3").split(",")
+    )
+]
+# Attempts per outbound call (1 disables retries) and the exponential backoff bounds
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "8"))
+# Longest Retry-After a provider may ask for before the call is given up instead
+RETRY_AFTER_MAX = float(os.environ.get("RETRY_AFTER_MAX", "30"))
+RETRY_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+tracing.metrics.describe(f"{tracing.METRIC_PREFIX}_retries_total", "Outbound calls retried after a transient error")
+
+# Absolute time.monotonic() by which the current request must finish, and the current stage
+_request_deadline = contextvars.ContextVar("request_deadline", default=None)
+_stage_deadline = contextvars.ContextVar("stage_deadline", default=None)
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the request's time budget runs out before work is started or retried."""
+
+def start(seconds=REQUEST_DEADLINE):
+    """
+    Give the request running in the current context an end-to-end time budget.
+    
+    The deadline is a context variable, so it follows the work into asyncio
+    tasks, asyncio.to_thread and functions wrapped with tracing.propagate.
+    Call clear() when the request is done.
+    
+    Args:
+        seconds (float): The budget; 0 or None means no deadline
+    """
+    _request_deadline.set(time.monotonic() + seconds if seconds else None)
+    _stage_deadline.set(None)
+
+def clear():
+    """Remove the current context's deadline."""
+    _request_deadline.set(None)
+    _stage_deadline.set(None)
+
+@contextmanager
+def deadline(seconds=REQUEST_DEADLINE):
+    """
+    Give the code in the block an end-to-end time budget (see start).
+    
+    Args:
+        seconds (float): The budget; 0 or None means no deadline
+    """
+    previous = (_request_deadline.get(), _stage_deadline.get())
+    start(seconds)
+    try:
+        yield
+    finally:
+        _request_deadline.set(previous[0])
+        _stage_deadline.set(previous[1])
+
+@contextmanager
+def stage(name):
+    """
+    Limit the block to the named stage's share of the time left in the request.
+    
+    Stages not listed in DEADLINE_STAGE_SHARES (and the last listed one) may
+    use all of it. Without an active request deadline this does nothing.
+    
+    Args:
+        name (str): "stt", "vision", "tts" or another stage name
+    """
+    request_deadline = _request_deadline.get()
+    previous = _stage_deadline.get()
+    if request_deadline is not None:
+        names = [stage_name for stage_name, _ in DEADLINE_STAGE_SHARES]
+        budget = request_deadline - time.monotonic()
+        if name in names:
+            later_shares = [share for _, share in DEADLINE_STAGE_SHARES[names.index(name):]]
+            budget *= later_shares[0] / sum(later_shares)
+        _stage_deadline.set(time.monotonic() + budget)
+    try:
+        yield
+    finally:
+        _stage_deadline.set(previous)
+
+def remaining():
+    """
+    Seconds left before the innermost active deadline.
+    
+    Returns:
+        float | None: The time left (negative once passed), or None without a deadline
+    """
+    deadlines = [value for value in (_request_deadline.get(), _stage_deadline.get()) if value is not None]
+    if not deadlines:
+        return None
+    return min(deadlines) - time.monotonic()
+
+def check(what):
+    """
+    Fail fast if the deadline has already passed.
+    
+    Args:
+        what (str): The work about to start, for the error message
+    
+    Raises:
+        DeadlineExceeded: If no time is left
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {what}")
+
+def call_timeout(what, default=HTTP_TIMEOUT):
+    """
+    Timeout for one outbound call: the default, shortened to the time left.
+    
+    Args:
+        what (str): The call, for the error message
+        default (float): Timeout when the deadline is further away
+    
+    Returns:
+        float: Seconds the call may take
+    
+    Raises:
+        DeadlineExceeded: If no time is left
+    """
+    check(what)
+    left = remaining()
+    return default if left is None else min(default, left)
+
+def _status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None and isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    return status
+
+def retry_after(error):
+    """
+    Read the Retry-After (or retry-after-ms) header from an API error, if it has one.
+    
+    Args:
+        error (Exception): The exception raised by the SDK
+    
+    Returns:
+        float | None: Seconds the provider asked us to wait
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # An HTTP date rather than a number of seconds
+            return email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+def is_transient(error):
+    """
+    Whether an error is worth retrying: rate limits, server errors, timeouts and dropped connections.
+    
+    Args:
+        error (Exception): The exception raised by the SDK
+    
+    Returns:
+        bool: True for 408/409/425/429/5xx statuses and network errors
+    """
+    if isinstance(error, DeadlineExceeded):
+        return False
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRY_STATUSES
+    if isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    try:
+        from groq import APIConnectionError
+    except ImportError:
+        return False
+    # Also covers APITimeoutError
+    return isinstance(error, APIConnectionError)
+
+def backoff_delay(attempt, requested=None):
+    """
+    How long to wait before the next attempt.
+    
+    Args:
+        attempt (int): Number of attempts made so far (1 after the first failure)
+        requested (float | None): Retry-After from the provider, if any
+    
+    Returns:
+        float: Seconds to sleep; at least what the provider asked for, with jitter
+    """
+    cap = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    # Half fixed, half random, so clients that failed together do not retry together
+    delay = cap / 2 + random.uniform(0, cap / 2)
+    if requested is not None:
+        delay = max(delay, requested + random.uniform(0, RETRY_BASE_DELAY))
+    return delay
+
+def call_with_retry(what, func, attempts=None):
+    """
+    Make an outbound call, retrying transient failures with exponential backoff and jitter.
+    
+    Each attempt gets a timeout bounded by the active deadline. Retries stop
+    when the attempts are used up, the error is not transient, the provider
+    asks to wait longer than RETRY_AFTER_MAX, or the wait would pass the deadline.
+    
+    Args:
+        what (str): Name of the call for logs and metrics, e.g. "groq.chat"
+        func (callable): Makes one attempt; called with the attempt's timeout in seconds
+        attempts (int): Maximum attempts, defaults to RETRY_ATTEMPTS
+    
+    Returns:
+        Whatever func returned
+    
+    Raises:
+        DeadlineExceeded: If the deadline passed before an attempt could start
+        Exception: The last error from func when it is not retried
+    """
+    attempts = max(attempts or RETRY_ATTEMPTS, 1)
+    for attempt in range(1, attempts + 1):
+        timeout = call_timeout(what)
+        try:
+            return func(timeout)
+        except Exception as e:
+            if attempt >= attempts or not is_transient(e):
+                raise
+            requested = retry_after(e)
+            if requested is not None and requested > RETRY_AFTER_MAX:
+                raise
+            delay = backoff_delay(attempt, requested)
+            left = remaining()
+            if left is not None and delay >= left:
+                logging.error(f"{what} failed and the deadline leaves no time to retry: {str(e)}")
+                raise
+            logging.warning(f"{what} failed, retrying in {delay:.2f}s (attempt {attempt + 1}/{attempts}): {str(e)}")
+            if tracing.TRACING_ENABLED:
+                tracing.metrics.inc(f"{tracing.METRIC_PREFIX}_retries_total", {"call": what})
+            time.sleep(delay)
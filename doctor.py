@@ -1,50 +1,145 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-import base64
-from groq import Groq
+from clients import get_groq_client
+from image_preprocessing import EncodedImage, preprocess_image
+from result_cache import ResultCache, fingerprint, make_key
+from provider_router import ProviderRouter
+from admission import STAGE_LIMITS
+from prompt_builder import Prompt, PromptBuilder
+from worker_pool import workers
+from deadlines import call_with_retry, check
+import tracing
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Checked when the first request is made, so importing this module never fails
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY environment variable is not set")
 
-def encode_image(image_path):
+# Enhanced system prompt for better medical responses
+system_prompt = """
+You are a compassionate and experienced medical doctor. Although this is for educational purposes, respond as if you're advising a real patient.
+Your role is to:
+1. Carefully analyze any provided images for medical conditions
+2. Listen to the patient's concerns and symptoms
+3. Provide a professional medical assessment
+4. Suggest appropriate next steps or remedies
+5. Maintain a caring and professional tone
+6. Generate a formal prescription when requested
+
+Guidelines:
+- Keep responses concise but informative
+- Use natural, conversational language
+- Avoid medical jargon unless necessary
+- Always err on the side of caution
+- Recommend professional medical consultation for serious concerns
+- Do not make definitive diagnoses without proper medical examination
+- Focus on education and guidance rather than treatment
+- When generating prescriptions, include:
+  * Patient's name and date
+  * Diagnosis
+  * Medications (if any)
+  * Dosage instructions
+  * Follow-up recommendations
+  * Doctor's signature
+
+Format your response as a natural conversation, avoiding bullet points or special characters.
+"""
+
+# Puts the system prompt in its own message, ahead of the conversation, so its prefix is reused
+prompt_builder = PromptBuilder(system_prompt)
+
+# Vision results keyed by image content, model and prompt
+analysis_cache = ResultCache("vision")
+
+# Vision models in order of preference; later ones are fallbacks
+VISION_MODELS = os.environ.get(
+    "VISION_MODELS",
+    "meta-llama/llama-4-maverick-17b-128e-instruct,meta-llama/llama-4-scout-17b-16e-instruct"
+).split(",")
+VISION_HEDGE = os.environ.get("VISION_HEDGE", "false").lower() in ("1", "true", "yes")
+
+def encode_image(image_path, affinity_key=None):
     """
-    Encode an image file to base64 string.
+    Preprocess an image file and encode it to base64.
+    
+    The work runs in a worker process when WORKER_PROCESSES is set.
     
     Args:
         image_path (str): Path to the image file
+        affinity_key (str): Routes the work to a worker, normally the session id
         
     Returns:
-        str: Base64 encoded image string
+        EncodedImage: Base64 encoded image with its MIME type and content hash
         
     Raises:
         FileNotFoundError: If the image file doesn't exist
         ValueError: If the file is not a valid image
     """
     try:
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image file not found: {image_path}")
-            
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            return encoded_string
+        with tracing.span("image.encode") as span:
+            encoded = workers.call(affinity_key, preprocess_image, image_path)
+            span.set(bytes_in=os.path.getsize(image_path), bytes_out=len(encoded.data),
+                     width=encoded.width, height=encoded.height, mime_type=encoded.mime_type)
+            return encoded
     except Exception as e:
         logging.error(f"Error encoding image: {str(e)}")
         raise
 
-def analyze_image_with_query(query, model, encoded_image):
+def _normalize_images(encoded_image):
+    if encoded_image is None:
+        return []
+    if isinstance(encoded_image, (str, EncodedImage)):
+        return [encoded_image]
+    return list(encoded_image)
+
+def _analysis_cache_key(query, model, encoded_images):
+    image_hashes = [
+        image.sha256 if isinstance(image, EncodedImage) else fingerprint(image)
+        for image in encoded_images
+    ]
+    query_hash = query.fingerprint if isinstance(query, Prompt) else fingerprint(query)
+    return make_key(model, query_hash, *image_hashes)
+
+def _build_messages(query, encoded_images):
+    content = [
+        {
+            "type": "text",
+            "text": query.text if isinstance(query, Prompt) else query
+        }
+    ]
+    for image in encoded_images:
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": image.data_url() if isinstance(image, EncodedImage) else f"data:image/jpeg;base64,{image}",
+            },
+        })
+    
+    # Images go on the latest user turn, after the system message and earlier turns
+    history = list(query.messages[:-1]) if isinstance(query, Prompt) else []
+    return history + [
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
+
+def analyze_image_with_query(query, model, encoded_image, use_cache=True):
     """
-    Analyze an image using the Groq API with a given query.
+    Analyze one or more images using the Groq API with a given query.
     
     Args:
-        query (str): The query to analyze the image with
+        query (str | Prompt): The query text, or a Prompt from prompt_builder with the
+            system message and conversation history
         model (str): The model to use for analysis
-        encoded_image (str): Base64 encoded image string
+        encoded_image (EncodedImage | str | list | None): An image from encode_image (a plain
+            base64 string is treated as JPEG), a list of them to send together in a single
+            multimodal message, or None for a text-only query
+        use_cache (bool): Return a cached answer for an identical image/model/prompt
+            combination, and cache new answers
         
     Returns:
         str: The analysis response from the model
@@ -53,35 +148,182 @@ def analyze_image_with_query(query, model, encoded_image):
         Exception: If there's an error in the API call
     """
     try:
-        client = Groq(api_key=GROQ_API_KEY)
+        with tracing.span("vision.analyze", model=model) as span:
+            client = get_groq_client(GROQ_API_KEY)
+            encoded_images = _normalize_images(encoded_image)
+            span.set(images=len(encoded_images))
+            
+            if use_cache:
+                cache_key = _analysis_cache_key(query, model, encoded_images)
+                cached = analysis_cache.get(cache_key)
+                span.set(cache_hit=cached is not None)
+                if cached is not None:
+                    logging.info("Vision cache hit")
+                    return cached
+            
+            messages = _build_messages(query, encoded_images)
+            span.set(bytes_in=_payload_size(messages))
+            if isinstance(query, Prompt):
+                span.set(estimated_prompt_tokens=query.tokens)
+            chat_completion = call_with_retry("groq.chat", lambda timeout: client.chat.completions.create(
+                messages=messages,
+                model=model,
+                temperature=0.7,  # Add some randomness to responses
+                max_tokens=500,   # Limit response length
+                timeout=timeout
+            ))
+            
+            response = chat_completion.choices[0].message.content
+            _record_usage(span, model, chat_completion.usage)
+            span.set(bytes_out=len(response or ""))
+            if use_cache and response:
+                analysis_cache.set(cache_key, response)
+            return response
         
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": query
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{encoded_image}",
-                        },
-                    },
-                ],
-            }
-        ]
+    except Exception as e:
+        logging.error(f"Error analyzing image: {str(e)}")
+        raise
+
+def stream_analyze_image_with_query(query, model, encoded_image, use_cache=True):
+    """
+    Streaming variant of analyze_image_with_query that yields text as it is generated.
+    
+    Args:
+        query (str | Prompt): The query text, or a Prompt from prompt_builder with the
+            system message and conversation history
+        model (str): The model to use for analysis
+        encoded_image (EncodedImage | str | list | None): Same as for analyze_image_with_query
+        use_cache (bool): Yield a cached answer in one piece on a hit, and cache the
+            full answer once the stream completes
         
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model=model,
-            temperature=0.7,  # Add some randomness to responses
-            max_tokens=500    # Limit response length
-        )
+    Yields:
+        str: Successive pieces (deltas) of the analysis response
         
-        return chat_completion.choices[0].message.content
+    Raises:
+        Exception: If there's an error in the API call
+    """
+    try:
+        with tracing.span("vision.stream", model=model) as span:
+            client = get_groq_client(GROQ_API_KEY)
+            encoded_images = _normalize_images(encoded_image)
+            span.set(images=len(encoded_images))
+            
+            if use_cache:
+                cache_key = _analysis_cache_key(query, model, encoded_images)
+                cached = analysis_cache.get(cache_key)
+                span.set(cache_hit=cached is not None)
+                if cached is not None:
+                    logging.info("Vision cache hit")
+                    yield cached
+                    return
+            
+            messages = _build_messages(query, encoded_images)
+            span.set(bytes_in=_payload_size(messages))
+            if isinstance(query, Prompt):
+                span.set(estimated_prompt_tokens=query.tokens)
+            # Only opening the stream is retried; once text has been yielded it cannot be taken back
+            stream = call_with_retry("groq.chat_stream", lambda timeout: client.chat.completions.create(
+                messages=messages,
+                model=model,
+                temperature=0.7,  # Add some randomness to responses
+                max_tokens=500,   # Limit response length
+                stream=True,
+                timeout=timeout
+            ))
+            
+            pieces = []
+            for chunk in stream:
+                check("the rest of the vision stream")
+                # Groq reports token usage on the final chunk
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    _record_usage(span, model, x_groq.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not pieces:
+                        span.set(first_token=span.elapsed())
+                    pieces.append(delta)
+                    yield delta
+            
+            span.set(bytes_out=sum(len(piece) for piece in pieces))
+            if use_cache and pieces:
+                analysis_cache.set(cache_key, "".join(pieces))
         
     except Exception as e:
         logging.error(f"Error analyzing image: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def _payload_size(messages):
+    """Approximate request size: the text and image data URLs sent to the model."""
+    size = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            size += len(content)
+            continue
+        for part in content:
+            size += len(part.get("text") or part.get("image_url", {}).get("url", ""))
+    return size
+
+def _record_usage(span, model, usage):
+    """Log the provider-reported token usage of a request and attach it to its span."""
+    if usage is None:
+        return
+    # Prompt tokens served from the provider's prefix cache, when it reports them
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+    span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens, cached_tokens=cached_tokens)
+    logging.info(
+        f"Vision usage ({model}): prompt_tokens={usage.prompt_tokens}, "
+        f"completion_tokens={usage.completion_tokens}, cached_tokens={cached_tokens}"
+    )
+
+def _model_provider(func, model):
+    return lambda query, encoded_image: func(query=query, model=model, encoded_image=encoded_image)
+
+vision_router = ProviderRouter(
+    "vision",
+    [(model, _model_provider(analyze_image_with_query, model)) for model in VISION_MODELS],
+    hedge=VISION_HEDGE,
+    hedge_workers=STAGE_LIMITS["vision"][0]
+)
+vision_stream_router = ProviderRouter(
+    "vision-stream",
+    [(model, _model_provider(stream_analyze_image_with_query, model)) for model in VISION_MODELS]
+)
+
+def analyze_image(query, encoded_image):
+    """
+    Analyze images with the healthiest vision model, falling back to the others.
+    
+    Args:
+        query (str | Prompt): The query text, or a Prompt from prompt_builder with the
+            system message and conversation history
+        encoded_image (EncodedImage | str | list | None): Same as for analyze_image_with_query
+        
+    Returns:
+        str: The analysis response from the model
+        
+    Raises:
+        AllProvidersFailedError: If every vision model failed
+    """
+    return vision_router.call(query, encoded_image)
+
+def stream_analyze_image(query, encoded_image):
+    """
+    Stream an analysis from the healthiest vision model, falling back before the first token.
+    
+    Args:
+        query (str | Prompt): The query text, or a Prompt from prompt_builder with the
+            system message and conversation history
+        encoded_image (EncodedImage | str | list | None): Same as for analyze_image_with_query
+        
+    Yields:
+        str: Successive pieces of the analysis response
+        
+    Raises:
+        AllProvidersFailedError: If no vision model could start a response
+    """
+    yield from vision_stream_router.stream(query, encoded_image)
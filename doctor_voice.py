@@ -1,45 +1,354 @@
 import os
+import re
+import io
+import queue
+import unicodedata
+import threading
 import platform
 import subprocess
-from gtts import gTTS
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import logging
-import elevenlabs
-from elevenlabs.client import ElevenLabs
+from clients import get_elevenlabs_client
+from result_cache import ResultCache, make_key
+from provider_router import ProviderRouter
+from deadlines import call_with_retry
+from admission import STAGE_LIMITS
+import tracing
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 load_dotenv()
 
+# Server-side playback is only useful when running the app on a machine with speakers
+LOCAL_PLAYBACK = os.environ.get("LOCAL_PLAYBACK", "false").lower() in ("1", "true", "yes")
+
 def text_to_speech_with_gtts(input_text, output_filepath):
-    language = "en"
+    """
+    Convert text to speech using gTTS.
+    
+    Args:
+        input_text (str): The text to convert to speech
+        output_filepath (str): Path to save the audio file
+        
+    Returns:
+        str: Path to the generated audio file
+    """
+    # Generate and save the speech, sentence by sentence through the speech cache
+    for _ in stream_text_to_speech(
+        split_sentences(input_text),
+        output_filepath,
+        synthesize=synthesize_speech_with_gtts
+    ):
+        pass
+    return output_filepath
 
-    # Generate the speech
-    audioobj = gTTS(text=input_text, lang=language, slow=False)
-    audioobj.save(output_filepath)
+# Checked when the first request is made, so importing this module never fails
+ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY")
 
-    os_name = platform.system()
-    try:
-        if os_name == "Windows":
-            os.startfile(output_filepath)  # ✅ FIXED: Autoplay works here
-        elif os_name == "Darwin":  # macOS
-            subprocess.run(['afplay', output_filepath])
-        elif os_name == "Linux":
-            subprocess.run(['mpg123', output_filepath])  # Ensure mpg123 is installed
+ELEVENLABS_VOICE = "Aria"  # Professional female voice
+ELEVENLABS_MODEL = "eleven_turbo_v2"
+ELEVENLABS_OUTPUT_FORMAT = "mp3_22050_32"
+
+# Number of sentences synthesized concurrently in streaming mode
+TTS_PIPELINE_DEPTH = int(os.environ.get("TTS_PIPELINE_DEPTH", "3"))
+# Sentences shorter than this are merged with the next one to avoid tiny TTS requests
+TTS_MIN_CHUNK_CHARS = int(os.environ.get("TTS_MIN_CHUNK_CHARS", "20"))
+
+# Synthesized sentences keyed by normalized text, voice, model and output format
+speech_cache = ResultCache("speech")
+
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+class SentenceSplitter:
+    """
+    Incrementally split streamed text into sentence-sized chunks for synthesis.
+    
+    Text is fed in arbitrary pieces (e.g. LLM deltas); complete sentences are
+    returned as soon as their terminating punctuation and following whitespace
+    arrive. Short sentences are held back and merged with the next one.
+    """
+    
+    def __init__(self, min_chars=None):
+        self.min_chars = min_chars if min_chars is not None else TTS_MIN_CHUNK_CHARS
+        self._buffer = ""
+        self._pending = ""
+    
+    def _emit(self, sentence):
+        self._pending = f"{self._pending} {sentence}".strip() if self._pending else sentence.strip()
+        if len(self._pending) >= self.min_chars:
+            chunk, self._pending = self._pending, ""
+            return [chunk]
+        return []
+    
+    def feed(self, text):
+        """
+        Add text and return any sentence chunks it completed.
+        
+        Args:
+            text (str): The next piece of the reply
+            
+        Returns:
+            list[str]: Chunks ready to synthesize, possibly empty
+        """
+        self._buffer += text
+        parts = _SENTENCE_BOUNDARY.split(self._buffer)
+        self._buffer = parts.pop()
+        chunks = []
+        for sentence in parts:
+            if sentence.strip():
+                chunks.extend(self._emit(sentence))
+        return chunks
+    
+    def flush(self):
+        """
+        Return whatever text is left once the reply is complete.
+        
+        Returns:
+            list[str]: The final chunk, or an empty list if nothing is left
+        """
+        remainder = f"{self._pending} {self._buffer}".strip()
+        self._buffer = ""
+        self._pending = ""
+        return [remainder] if remainder else []
+
+def split_sentences(text, min_chars=None):
+    """
+    Split a complete reply into sentence chunks for synthesis.
+    
+    Args:
+        text (str): The text to split
+        min_chars (int): Minimum chunk length, defaults to TTS_MIN_CHUNK_CHARS
+        
+    Returns:
+        list[str]: The sentence chunks in order
+    """
+    splitter = SentenceSplitter(min_chars)
+    return splitter.feed(text) + splitter.flush()
+
+def normalize_tts_text(text):
+    """
+    Normalize text so trivially different spellings of a sentence share a cache entry.
+    
+    Args:
+        text (str): The text to normalize
+        
+    Returns:
+        str: NFKC-normalized text with whitespace collapsed
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def _cached_speech(provider, input_text, voice, model, output_format, synthesize, use_cache):
+    with tracing.span(f"tts.{provider}", voice=voice, model=model) as span:
+        span.set(bytes_in=len(input_text))
+        if not use_cache:
+            audio = synthesize(input_text)
         else:
-            raise OSError("Unsupported operating system")
-    except Exception as e:
-        print(f"An error occurred while trying to play the audio: {e}")
+            key = make_key(voice, model, output_format, normalize_tts_text(input_text))
+            audio = speech_cache.get(key)
+            span.set(cache_hit=audio is not None)
+            if audio is None:
+                audio = synthesize(input_text)
+                speech_cache.set(key, audio)
+        span.set(bytes_out=len(audio))
+        return audio
 
-ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY")
-if not ELEVENLABS_API_KEY:
-    raise ValueError("ELEVENLABS_API_KEY environment variable is not set")
+# Voice name -> voice ID, so the voice list is fetched once rather than on every request
+_voice_ids = {}
+
+def _elevenlabs_voice_id(client, voice_name):
+    voice_id = _voice_ids.get(voice_name)
+    if voice_id is None:
+        voices = call_with_retry("elevenlabs.voices", lambda timeout: client.voices.get_all(
+            show_legacy=True, request_options={"timeout_in_seconds": timeout}
+        )).voices
+        voice_id = next((voice.voice_id for voice in voices if voice.name == voice_name), None)
+        if voice_id is None:
+            raise ValueError(f"ElevenLabs voice not found: {voice_name}")
+        _voice_ids[voice_name] = voice_id
+    return voice_id
+
+def synthesize_speech_with_elevenlabs(input_text, use_cache=True):
+    """
+    Synthesize text with ElevenLabs and return the MP3 bytes.
+    
+    Args:
+        input_text (str): The text to convert to speech
+        use_cache (bool): Reuse audio previously synthesized for the same text and voice
+        
+    Returns:
+        bytes: MP3 audio
+    """
+    def synthesize(text):
+        client = get_elevenlabs_client(ELEVENLABS_API_KEY)
+        voice_id = _elevenlabs_voice_id(client, ELEVENLABS_VOICE)
+        
+        def attempt(timeout):
+            audio = client.text_to_speech.convert(
+                voice_id=voice_id,
+                text=text,
+                output_format=ELEVENLABS_OUTPUT_FORMAT,
+                model_id=ELEVENLABS_MODEL,
+                request_options={"timeout_in_seconds": timeout}
+            )
+            # The response is streamed, so errors can surface while reading it
+            return audio if isinstance(audio, bytes) else b"".join(audio)
+        
+        return call_with_retry("elevenlabs.tts", attempt)
+    
+    return _cached_speech("elevenlabs", input_text, ELEVENLABS_VOICE, ELEVENLABS_MODEL, ELEVENLABS_OUTPUT_FORMAT, synthesize, use_cache)
+
+def synthesize_speech_with_gtts(input_text, use_cache=True):
+    """
+    Synthesize text with gTTS and return the MP3 bytes.
+    
+    Args:
+        input_text (str): The text to convert to speech
+        use_cache (bool): Reuse audio previously synthesized for the same text
+        
+    Returns:
+        bytes: MP3 audio
+    """
+    def synthesize(text):
+        from gtts import gTTS
+        from gtts.tts import gTTSError
+        
+        def attempt(timeout):
+            buffer = io.BytesIO()
+            try:
+                gTTS(text=text, lang="en", slow=False, timeout=timeout).write_to_fp(buffer)
+            except gTTSError as e:
+                # gTTS hides the HTTP status; expose it like the other SDKs so retries and health tracking see it
+                if e.rsp is None:
+                    raise ConnectionError(str(e)) from e
+                e.status_code = e.rsp.status_code
+                raise
+            return buffer.getvalue()
+        
+        return call_with_retry("gtts", attempt)
+    
+    return _cached_speech("gtts", input_text, "gtts-en", "gtts", "mp3", synthesize, use_cache)
+
+# ElevenLabs first, gTTS as the backup. Hedging to gTTS when ElevenLabs is slower than
+# usual is off by default: a hedged first sentence switches the whole reply to gTTS's voice
+TTS_HEDGE = os.environ.get("TTS_HEDGE", "false").lower() in ("1", "true", "yes")
+tts_router = ProviderRouter(
+    "tts",
+    [("elevenlabs", synthesize_speech_with_elevenlabs), ("gtts", synthesize_speech_with_gtts)],
+    hedge=TTS_HEDGE,
+    hedge_workers=STAGE_LIMITS["tts"][0] * TTS_PIPELINE_DEPTH
+)
+
+def synthesize_speech(input_text):
+    """
+    Synthesize text with the healthiest TTS provider (ElevenLabs, then gTTS).
+    
+    Args:
+        input_text (str): The text to convert to speech
+        
+    Returns:
+        bytes: MP3 audio
+        
+    Raises:
+        AllProvidersFailedError: If no provider could synthesize the text
+    """
+    return tts_router.call(input_text)
+
+class ReplyVoice:
+    """
+    Synthesize the sentences of one reply with a single TTS provider.
+    
+    The providers use different voices and sample rates, and their MP3 frames
+    cannot be mixed in one file. The first sentence is routed as usual
+    (falling back or hedging if needed) and picks the provider; every later
+    sentence waits for that choice and uses the same provider, failing rather
+    than switching voice mid-reply.
+    """
+    
+    def __init__(self, router=None):
+        self.router = router or tts_router
+        self.provider = None
+        self._claimed = False
+        self._chosen = threading.Event()
+        self._lock = threading.Lock()
+    
+    def __call__(self, input_text):
+        with self._lock:
+            first, self._claimed = not self._claimed, True
+        if first:
+            try:
+                self.provider, audio = self.router.route(input_text)
+            finally:
+                self._chosen.set()
+            return audio
+        self._chosen.wait()
+        if self.provider is None:
+            raise RuntimeError("No TTS provider could synthesize the start of the reply")
+        return self.router.call_provider(self.provider, input_text)
+
+def stream_text_to_speech(sentences, output_filepath, pipeline_depth=None, synthesize=None):
+    """
+    Synthesize sentence chunks in a pipeline and yield their audio in order.
+    
+    Sentences are consumed as they become available (e.g. from a queue fed by a
+    streaming LLM reply), up to pipeline_depth of them are synthesized at once,
+    and each chunk's audio is yielded as soon as it and all earlier chunks are
+    ready. The concatenated audio is also written to output_filepath.
+    
+    Args:
+        sentences (iterable[str]): Sentence chunks, possibly produced while iterating
+        output_filepath (str): Path to save the full audio file
+        pipeline_depth (int): Maximum concurrent synthesis requests, defaults to TTS_PIPELINE_DEPTH
+        synthesize (callable): Turns one chunk of text into MP3 bytes, defaults to a
+            ReplyVoice so the whole reply uses one provider
+        
+    Yields:
+        bytes: MP3 audio for each chunk, in sentence order
+        
+    Raises:
+        Exception: If synthesizing any chunk fails
+    """
+    pipeline_depth = pipeline_depth or TTS_PIPELINE_DEPTH
+    synthesize = synthesize or ReplyVoice()
+    futures = queue.Queue()
+    
+    with ThreadPoolExecutor(max_workers=pipeline_depth) as executor, tracing.span("tts.stream") as span:
+        def feed():
+            try:
+                for sentence in sentences:
+                    futures.put(executor.submit(tracing.propagate(synthesize), sentence))
+            except Exception as e:
+                logging.error(f"Error reading sentences for speech synthesis: {str(e)}")
+            finally:
+                futures.put(None)
+        
+        # Feed from a separate thread so finished chunks are yielded without waiting for the next sentence
+        feeder = threading.Thread(target=tracing.propagate(feed), daemon=True)
+        feeder.start()
+        
+        chunks = 0
+        audio_bytes = 0
+        with open(output_filepath, "wb") as output_file:
+            for future in iter(futures.get, None):
+                audio = future.result()
+                output_file.write(audio)
+                if not chunks:
+                    span.set(first_chunk=span.elapsed())
+                chunks += 1
+                audio_bytes += len(audio)
+                span.set(chunks=chunks, bytes_out=audio_bytes)
+                yield audio
+    
+    logging.info(f"Audio saved to {output_filepath}")
 
 def text_to_speech_with_elevenlabs(input_text, output_filepath):
     """
     Convert text to speech using ElevenLabs API.
     
+    The text is synthesized sentence by sentence so repeated sentences (greetings,
+    disclaimers) come from the speech cache, and the pieces are joined into one file.
+    
     Args:
         input_text (str): The text to convert to speech
         output_filepath (str): Path to save the audio file
@@ -54,52 +363,82 @@ def text_to_speech_with_elevenlabs(input_text, output_filepath):
         if not input_text:
             raise ValueError("Input text cannot be empty")
             
-        client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
+        # Generate and save the audio
+        for _ in stream_text_to_speech(
+            split_sentences(input_text),
+            output_filepath,
+            synthesize=synthesize_speech_with_elevenlabs
+        ):
+            pass
         
-        # Generate the audio
-        audio = client.generate(
-            text=input_text,
-            voice="Aria",  # Professional female voice
-            output_format="mp3_22050_32",
-            model="eleven_turbo_v2"
-        )
+        return output_filepath
         
-        # Save the audio file
-        elevenlabs.save(audio, output_filepath)
-        logging.info(f"Audio saved to {output_filepath}")
+    except Exception as e:
+        logging.error(f"Error in text-to-speech conversion: {str(e)}")
+        raise
+
+def text_to_speech(input_text, output_filepath):
+    """
+    Convert text to speech with whichever TTS provider is healthy, sentence by sentence.
+    
+    Args:
+        input_text (str): The text to convert to speech
+        output_filepath (str): Path to save the audio file
         
-        # Play the audio file
-        play_audio(output_filepath)
+    Returns:
+        str: Path to the generated audio file
         
+    Raises:
+        Exception: If there's an error during text-to-speech conversion
+    """
+    try:
+        if not input_text:
+            raise ValueError("Input text cannot be empty")
+        for _ in stream_text_to_speech(split_sentences(input_text), output_filepath):
+            pass
         return output_filepath
-        
     except Exception as e:
         logging.error(f"Error in text-to-speech conversion: {str(e)}")
         raise
 
+# Player processes still running, kept so they can be reaped once finished
+_players = []
+
 def play_audio(filepath):
     """
-    Play an audio file using the appropriate system command.
+    Start playing an audio file on the local machine without waiting for it to finish.
     
     Args:
         filepath (str): Path to the audio file to play
         
     Raises:
         OSError: If the operating system is not supported
-        Exception: If there's an error playing the audio
+        Exception: If there's an error starting the player
     """
     try:
+        # Reap players that have already exited
+        _players[:] = [player for player in _players if player.poll() is None]
+        
         os_name = platform.system()
         
         if os_name == "Windows":
             os.startfile(filepath)
+            return
         elif os_name == "Darwin":  # macOS
-            subprocess.run(['afplay', filepath])
+            command = ['afplay', filepath]
         elif os_name == "Linux":
-            subprocess.run(['mpg123', filepath])
+            command = ['mpg123', '-q', filepath]
         else:
             raise OSError(f"Unsupported operating system: {os_name}")
+        
+        _players.append(subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        ))
             
     except Exception as e:
         logging.error(f"Error playing audio: {str(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -2,205 +2,556 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import asyncio
+import time
+import logging
+import threading
+import queue
 import gradio as gr
-import tempfile
-import shutil
-from datetime import datetime
-import json
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 
-from doctor import encode_image, analyze_image_with_query
-from patient_voice import record_audio, transcribe_with_groq
-from doctor_voice import text_to_speech_with_elevenlabs
+from doctor import encode_image, analyze_image, stream_analyze_image, prompt_builder
+from patient_voice import transcribe_audio
+from doctor_voice import text_to_speech, stream_text_to_speech, SentenceSplitter, play_audio, LOCAL_PLAYBACK
+from session_store import SessionStore
+from prescription import generate_prescription
+from artifact_store import artifacts, ARTIFACT_MAX_AGE, ARTIFACT_SWEEP_INTERVAL
+from admission import STAGE_LIMITS, AdmissionRejected, stage_limiters, rate_limiter, rate_limit_key, admission_metrics
+from result_cache import cache_stats
+from provider_router import router_stats
+from worker_pool import workers
+from speculation import speculative_vision, FINDINGS_CONTEXT
+import deadlines
+import tracing
+from consultation_log import consultation_log, CONSULTATION_LOG_ENABLED
 
-# Enhanced system prompt for better medical responses
-system_prompt = """
-You are a compassionate and experienced medical doctor. Although this is for educational purposes, respond as if you're advising a real patient.
-Your role is to:
-1. Carefully analyze any provided images for medical conditions
-2. Listen to the patient's concerns and symptoms
-3. Provide a professional medical assessment
-4. Suggest appropriate next steps or remedies
-5. Maintain a caring and professional tone
-6. Generate a formal prescription when requested
+# Conversation history, kept per browser session with a bounded token budget
+session_store = SessionStore()
 
-Guidelines:
-- Keep responses concise but informative
-- Use natural, conversational language
-- Avoid medical jargon unless necessary
-- Always err on the side of caution
-- Recommend professional medical consultation for serious concerns
-- Do not make definitive diagnoses without proper medical examination
-- Focus on education and guidance rather than treatment
-- When generating prescriptions, include:
-  * Patient's name and date
-  * Diagnosis
-  * Medications (if any)
-  * Dosage instructions
-  * Follow-up recommendations
-  * Doctor's signature
+# How multiple uploaded images are analyzed:
+#   "merged"   - all images go to the vision model in one multimodal message
+#   "parallel" - one request per image, fanned out over a bounded worker pool
+IMAGE_ANALYSIS_MODE = os.environ.get("IMAGE_ANALYSIS_MODE", "merged")
+IMAGE_ANALYSIS_CONCURRENCY = int(os.environ.get("IMAGE_ANALYSIS_CONCURRENCY", "4"))
 
-Format your response as a natural conversation, avoiding bullet points or special characters.
-"""
+# Synthesize the voice reply sentence by sentence while the text is still streaming
+TTS_STREAMING = os.environ.get("TTS_STREAMING", "true").lower() in ("1", "true", "yes")
 
-# Global variable to store conversation history
-conversation_history = []
+# "lazy" renders the prescription only when the patient asks for it,
+# "eager" renders it on every turn, overlapped with speech synthesis
+PRESCRIPTION_MODE = os.environ.get("PRESCRIPTION_MODE", "lazy")
 
-def generate_prescription(doctor_response, patient_name="Patient"):
-    """Generate a PDF prescription from the doctor's response."""
+# Consultations run at once by Gradio, and requests allowed to wait in its queue
+GRADIO_CONCURRENCY = int(os.environ.get("GRADIO_CONCURRENCY", "16"))
+GRADIO_MAX_QUEUE = int(os.environ.get("GRADIO_MAX_QUEUE", "64"))
+# Prescription downloads run at once, matching the PDF stage's slots
+PDF_CONCURRENCY = STAGE_LIMITS["pdf"][0]
+
+# Callables receiving each request's stage timings dict, e.g. the benchmark harness
+stage_timing_observers = []
+
+# Marks the end of one source in _merge_streams
+_STREAM_END = object()
+
+async def _run_stage(stage_timings, stage_name, func, *args, **kwargs):
+    """
+    Run a blocking pipeline stage in a worker thread and record how long it took.
+    
+    Args:
+        stage_timings (dict): Mapping of stage name to elapsed seconds, updated in place
+        stage_name (str): Name the timing is recorded under
+        func (callable): The blocking function to run
+        
+    Returns:
+        The return value of func
+    """
+    start = time.perf_counter()
     try:
-        # Create a temporary file for the prescription
-        temp_dir = tempfile.mkdtemp()
-        prescription_path = os.path.join(temp_dir, "prescription.pdf")
+        return await asyncio.to_thread(func, *args, **kwargs)
+    finally:
+        stage_timings[stage_name] = time.perf_counter() - start
+
+async def _iterate_in_thread(func, *args, **kwargs):
+    """
+    Drive a blocking generator in a worker thread and yield its items on the event loop.
+    
+    Args:
+        func (callable): Generator function to run
         
-        # Create the PDF
-        doc = SimpleDocTemplate(prescription_path, pagesize=letter)
-        styles = getSampleStyleSheet()
-        story = []
+    Yields:
+        Each item produced by func(*args, **kwargs)
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    finished = object()
+    
+    def worker():
+        try:
+            for item in func(*args, **kwargs):
+                if stopped.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (finished, e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, (finished, None))
+    
+    loop.run_in_executor(None, tracing.propagate(worker))
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # Let the worker stop early if the consumer goes away mid-stream
+        stopped.set()
+
+async def _merge_streams(**streams):
+    """
+    Interleave several async iterators, yielding items from whichever produces first.
+    
+    Yields:
+        tuple: (name, item, error) for each item; when a stream finishes, item is
+            _STREAM_END and error holds the exception that ended it, if any
+    """
+    events = asyncio.Queue()
+    
+    async def pump(name, stream):
+        try:
+            async for item in stream:
+                await events.put((name, item, None))
+        except Exception as e:
+            await events.put((name, _STREAM_END, e))
+        else:
+            await events.put((name, _STREAM_END, None))
+    
+    tasks = [asyncio.create_task(pump(name, stream)) for name, stream in streams.items()]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await events.get()
+            if event[1] is _STREAM_END:
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _speech_stream(sentence_queue, speech_started, output_filepath):
+    """
+    Synthesize the reply's sentences as they are queued and yield their audio.
+    
+    A TTS slot (and the TTS share of the deadline) is taken only once the first
+    sentence or the end of the reply has been queued, so time spent waiting on
+    the vision model does not hold TTS capacity.
+    
+    Args:
+        sentence_queue (queue.Queue): Sentences to synthesize, ended by None
+        speech_started (asyncio.Event): Set when the first item is queued
+        output_filepath (str): Path to save the full audio file
         
-        # Add header
-        header_style = ParagraphStyle(
-            'CustomHeader',
-            parent=styles['Heading1'],
-            fontSize=24,
-            spaceAfter=30
-        )
-        story.append(Paragraph("Medical Prescription", header_style))
+    Yields:
+        bytes: MP3 audio for each sentence, in order
+    """
+    await speech_started.wait()
+    async with stage_limiters["tts"]:
+        with deadlines.stage("tts"):
+            async for audio in _iterate_in_thread(
+                stream_text_to_speech,
+                iter(sentence_queue.get, None),
+                output_filepath=output_filepath
+            ):
+                yield audio
+
+def _busy_message(error):
+    """Status message for a request (or stage) turned away by admission control."""
+    retry = f" Please try again in {error.retry_after:.0f} seconds." if error.retry_after else " Please try again shortly."
+    return f"The service is busy: {str(error)}.{retry}"
+
+def _timeout_message(error):
+    """Status message for a request (or stage) that ran out of time."""
+    return f"The request took too long: {str(error)}. Please try again."
+
+async def _render_prescription(stage_timings, doctor_response, patient_name, session_id):
+    async with stage_limiters["pdf"]:
+        return await _run_stage(stage_timings, "prescription", generate_prescription, doctor_response, patient_name, session_id)
+
+async def analyze_images(encoded_images, query, stage_timings, mode=None, concurrency=None):
+    """
+    Analyze a batch of encoded images, either in one merged request or fanned out per image.
+    
+    Args:
+        encoded_images (list[str]): Base64 encoded images in upload order
+        query (str): The prompt sent alongside the images
+        stage_timings (dict): Mapping of stage name to elapsed seconds, updated in place
+            with a "vision[i]" entry per image
+        mode (str): "merged" or "parallel", defaults to IMAGE_ANALYSIS_MODE
+        concurrency (int): Maximum in-flight requests in parallel mode,
+            defaults to IMAGE_ANALYSIS_CONCURRENCY
         
-        # Add date and patient info
-        date_style = ParagraphStyle(
-            'DateStyle',
-            parent=styles['Normal'],
-            fontSize=12,
-            spaceAfter=20
-        )
-        story.append(Paragraph(f"Date: {datetime.now().strftime('%Y-%m-%d')}", date_style))
-        story.append(Paragraph(f"Patient: {patient_name}", date_style))
-        story.append(Spacer(1, 20))
+    Returns:
+        list[str]: A single combined analysis in merged mode, otherwise one analysis
+            per image in the same order as encoded_images
         
-        # Add prescription content
-        content_style = ParagraphStyle(
-            'ContentStyle',
-            parent=styles['Normal'],
-            fontSize=12,
-            spaceAfter=12
+    Raises:
+        ValueError: If the mode is not recognised
+    """
+    mode = mode or IMAGE_ANALYSIS_MODE
+    concurrency = concurrency or IMAGE_ANALYSIS_CONCURRENCY
+    
+    if mode == "merged":
+        start = time.perf_counter()
+        analysis = await asyncio.to_thread(
+            analyze_image,
+            query=query,
+            encoded_image=list(encoded_images)
         )
-        story.append(Paragraph(doctor_response, content_style))
+        # A merged request has one round trip, so report its cost amortized per image
+        per_image = (time.perf_counter() - start) / max(len(encoded_images), 1)
+        for i in range(len(encoded_images)):
+            stage_timings[f"vision[{i}]"] = per_image
+        return [analysis]
+    
+    if mode == "parallel":
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
         
-        # Add footer
-        footer_style = ParagraphStyle(
-            'FooterStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            spaceBefore=30
-        )
-        story.append(Spacer(1, 50))
-        story.append(Paragraph("This is a computer-generated prescription for educational purposes only.", footer_style))
-        story.append(Paragraph("Please consult with a healthcare professional for proper medical advice.", footer_style))
+        async def analyze_one(i, encoded_image):
+            async with semaphore:
+                return await _run_stage(
+                    stage_timings,
+                    f"vision[{i}]",
+                    analyze_image,
+                    query=query,
+                    encoded_image=encoded_image
+                )
         
-        # Build the PDF
-        doc.build(story)
-        return prescription_path
+        # gather() preserves argument order, so results stay in upload order
+        return await asyncio.gather(*[analyze_one(i, image) for i, image in enumerate(encoded_images)])
+    
+    raise ValueError(f"Unknown image analysis mode: {mode}")
+
+async def _doctor_reply_stream(encode_tasks, query, stage_timings, speculation=None):
+    """
+    Yield the doctor's reply in pieces as the vision model produces it.
+    
+    In parallel image mode the per-image analyses are awaited and yielded as one
+    piece; otherwise a single (merged or text-only) request is streamed. If a
+    speculative first pass already described the images, its findings are
+    added to the question and the request is sent without the images.
+    
+    Args:
+        encode_tasks (list[asyncio.Task]): Image encoding tasks, in upload order
+        query (Prompt): The prompt sent to the vision model
+        stage_timings (dict): Mapping of stage name to elapsed seconds, updated in place
+        speculation (Speculation): Work started when the images were uploaded, if any
         
-    except Exception as e:
-        logging.error(f"Error generating prescription: {str(e)}")
-        return None
+    Yields:
+        str: Successive pieces of the reply
+    """
+    encoded_images = await asyncio.gather(*encode_tasks)
+    
+    if speculation is not None:
+        wait_start = time.perf_counter()
+        try:
+            findings = await asyncio.wait_for(speculation.findings(), deadlines.remaining())
+        except asyncio.TimeoutError:
+            # Out of time for the first pass; drop it and send the images themselves
+            logging.warning("Speculative image analysis missed the request deadline")
+            speculation.cancel()
+            findings = None
+        stage_timings["speculation_wait"] = time.perf_counter() - wait_start
+        if findings:
+            # The images were analyzed while the patient was talking; a text-only refinement is much cheaper
+            query = prompt_builder.extend_question(query, FINDINGS_CONTEXT.format(findings=findings))
+            encoded_images = []
+    
+    async with stage_limiters["vision"]:
+        with deadlines.stage("vision"):
+            if encoded_images and IMAGE_ANALYSIS_MODE == "parallel":
+                # Per-image requests cannot be streamed as one reply, so wait for all of them
+                all_analyses = await analyze_images(encoded_images, query=query, stage_timings=stage_timings)
+                yield "\n\n".join(all_analyses)
+                return
+            
+            vision_start = time.perf_counter()
+            first = True
+            async for delta in _iterate_in_thread(
+                stream_analyze_image,
+                query=query,
+                encoded_image=encoded_images or None
+            ):
+                if first:
+                    stage_timings["vision_first_token"] = time.perf_counter() - vision_start
+                    first = False
+                yield delta
+            stage_timings["vision"] = time.perf_counter() - vision_start
+            for i in range(len(encoded_images)):
+                stage_timings[f"vision[{i}]"] = stage_timings["vision"] / len(encoded_images)
+
+async def speculate_on_upload(image_filepaths, request: gr.Request = None):
+    """
+    Start encoding and a first-pass analysis of newly uploaded images, cancelling work for earlier uploads.
+    
+    The first pass runs only in merged mode, where submit sends the images in one request,
+    and is charged to the same key (session or client IP) as the submit rate limit.
+    """
+    session_id = request.session_hash if request is not None and request.session_hash else "default"
+    speculative_vision.start(
+        session_id, image_filepaths,
+        first_pass=IMAGE_ANALYSIS_MODE == "merged",
+        budget_key=rate_limit_key(request)
+    )
 
-def process_inputs(audio_filepath, image_filepaths, chat_history, patient_name):
-    global conversation_history
+async def process_inputs(audio_filepath, image_filepaths, chat_history, patient_name, request: gr.Request = None):
+    """
+    Run one consultation turn, yielding UI updates as the doctor's reply streams in.
+    
+    With TTS_STREAMING enabled, complete sentences of the reply are synthesized
+    while the rest of the text is still being generated, and their audio is
+    streamed to the audio output as it becomes ready.
+    
+    Yields:
+        tuple: (chatbot, chat_history, audio_output, prescription_output, status) updates
+    """
+    session_id = request.session_hash if request is not None and request.session_hash else "default"
+    stage_timings = {}
+    pipeline_start = time.perf_counter()
+    sentence_queue = queue.Queue()
+    speech_started = asyncio.Event()
+    trace = tracing.start_trace("consultation", session_id=session_id, images=len(image_filepaths or []))
+    trace_status = "ok"
+    # Split across transcription, vision and speech; outbound calls stop retrying once it passes
+    deadlines.start()
+    speech_to_text_output = None
+    doctor_response = None
+    prescription_path = None
+    temp_response_path = None
     
     try:
-        # Create a temporary directory for audio files
-        temp_dir = tempfile.mkdtemp()
-        temp_audio_path = os.path.join(temp_dir, "temp_audio.mp3")
-        temp_response_path = os.path.join(temp_dir, "doctor_response.mp3")
+        # Turn away sessions (or clients) that are sending requests too quickly
+        rate_limiter.check(rate_limit_key(request))
+        
+        # The voice reply is written to this session's artifact namespace
+        temp_response_path = artifacts.new_path(session_id, "doctor_response.mp3")
+        
+        # Encode images while the audio is being transcribed, unless that started on upload
+        image_filepaths = image_filepaths or []
+        speculation = speculative_vision.take(session_id, image_filepaths) if image_filepaths else None
+        if speculation is not None:
+            encode_tasks = speculation.encode_tasks
+        else:
+            encode_tasks = [
+                asyncio.create_task(_run_stage(stage_timings, f"encode_image[{i}]", encode_image, image_path, affinity_key=session_id))
+                for i, image_path in enumerate(image_filepaths)
+            ]
         
         # Process audio input
         if audio_filepath:
-            speech_to_text_output = transcribe_with_groq(
-                GROQ_API_KEY=os.environ.get("GROQ_API_KEY"),
-                audio_filepath=audio_filepath,
-                stt_model="whisper-large-v3"
-            )
+            try:
+                async with stage_limiters["stt"]:
+                    with deadlines.stage("stt"):
+                        speech_to_text_output = await _run_stage(
+                            stage_timings,
+                            "transcription",
+                            transcribe_audio,
+                            audio_filepath=audio_filepath
+                        )
+            except Exception:
+                for task in encode_tasks:
+                    task.cancel()
+                if speculation is not None:
+                    speculation.cancel()
+                raise
         else:
             speech_to_text_output = "No audio input provided."
 
         # Add user input to conversation history
-        conversation_history.append({"role": "user", "content": speech_to_text_output})
+        session_store.append(session_id, "user", speech_to_text_output)
         chat_history.append({"role": "user", "content": speech_to_text_output})
+        yield chat_history, chat_history, None, None, ""
 
-        # Process multiple images
-        if image_filepaths:
-            try:
-                # Combine all image analyses
-                all_analyses = []
-                for image_path in image_filepaths:
-                    encoded_image = encode_image(image_path)
-                    conversation_context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation_history])
-                    analysis = analyze_image_with_query(
-                        query=system_prompt + "\nPrevious conversation:\n" + conversation_context,
-                        encoded_image=encoded_image,
-                        model="meta-llama/llama-4-maverick-17b-128e-instruct"
-                    )
-                    all_analyses.append(analysis)
+        # System message first, then the conversation; earlier turns stay identical so the prefix is reusable
+        query = prompt_builder.build(session_store.get_messages(session_id))
+        logging.info(f"Prompt: {query.tokens} estimated tokens in {len(query.messages)} messages")
+        
+        streams = {"text": _doctor_reply_stream(encode_tasks, query, stage_timings, speculation)}
+        if TTS_STREAMING:
+            streams["audio"] = _speech_stream(sentence_queue, speech_started, temp_response_path)
+        
+        def queue_sentence(sentence):
+            # None ends the reply; either way the speech stream can stop waiting for text
+            sentence_queue.put(sentence)
+            speech_started.set()
+        
+        splitter = SentenceSplitter()
+        pieces = []
+        prescription_task = None
+        tts_error = None
+        tts_start = None
+        
+        chat_history.append({"role": "assistant", "content": ""})
+        async for source, item, error in _merge_streams(**streams):
+            if source == "text":
+                if item is not _STREAM_END:
+                    pieces.append(item)
+                    chat_history[-1]["content"] = "".join(pieces)
+                    for sentence in splitter.feed(item):
+                        tts_start = tts_start or time.perf_counter()
+                        queue_sentence(sentence)
+                    yield chat_history, chat_history, None, None, ""
+                    continue
                 
-                # Combine all analyses into one response
-                doctor_response = "\n\n".join(all_analyses)
-            except Exception as e:
-                doctor_response = f"Error analyzing images: {str(e)}"
-        else:
-            # If no images, still include conversation history
-            conversation_context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation_history])
-            doctor_response = analyze_image_with_query(
-                query=system_prompt + "\nPrevious conversation:\n" + conversation_context,
-                encoded_image=None,
-                model="meta-llama/llama-4-maverick-17b-128e-instruct"
-            )
-
-        # Add doctor's response to conversation history
-        conversation_history.append({"role": "assistant", "content": doctor_response})
-        chat_history.append({"role": "assistant", "content": doctor_response})
-
-        # Generate prescription
-        prescription_path = generate_prescription(doctor_response, patient_name)
-
-        # Try ElevenLabs first, fall back to gTTS if quota exceeded
-        try:
-            text_to_speech_with_elevenlabs(
-                input_text=doctor_response,
-                output_filepath=temp_response_path
-            )
-        except Exception as e:
-            if "quota_exceeded" in str(e):
-                try:
-                    from doctor_voice import text_to_speech_with_gtts
-                    text_to_speech_with_gtts(
-                        input_text=doctor_response,
-                        output_filepath=temp_response_path
+                if error is not None:
+                    if not image_filepaths or isinstance(error, (AdmissionRejected, deadlines.DeadlineExceeded)):
+                        raise error
+                    doctor_response = f"Error analyzing images: {str(error)}"
+                else:
+                    doctor_response = "".join(pieces)
+                    for sentence in splitter.flush():
+                        tts_start = tts_start or time.perf_counter()
+                        queue_sentence(sentence)
+                if not pieces and error is not None:
+                    queue_sentence(doctor_response)
+                queue_sentence(None)
+                
+                # Add doctor's response to conversation history
+                chat_history[-1]["content"] = doctor_response
+                session_store.append(session_id, "assistant", doctor_response)
+                stage_timings["reply_complete"] = time.perf_counter() - pipeline_start
+                
+                # Render the prescription while the voice response is synthesized
+                if PRESCRIPTION_MODE == "eager":
+                    prescription_task = asyncio.create_task(
+                        _render_prescription(stage_timings, doctor_response, patient_name, session_id)
                     )
-                except Exception as gtts_error:
-                    return chat_history, chat_history, None, prescription_path, f"Error generating voice response: {str(gtts_error)}"
+                yield chat_history, chat_history, None, None, ""
+            
+            elif item is _STREAM_END:
+                tts_error = error
+                if tts_start is not None:
+                    stage_timings["tts"] = time.perf_counter() - tts_start
             else:
-                return chat_history, chat_history, None, prescription_path, f"Error generating voice response: {str(e)}"
+                if "first_audio" not in stage_timings:
+                    stage_timings["first_audio"] = time.perf_counter() - pipeline_start
+                yield chat_history, chat_history, item, None, ""
 
-        # Play the audio file
-        try:
-            from doctor_voice import play_audio
-            play_audio(temp_response_path)
-        except Exception as e:
-            return chat_history, chat_history, temp_response_path, prescription_path, f"Error playing audio: {str(e)}"
+        if TTS_STREAMING:
+            prescription_path = await prescription_task if prescription_task else None
+            if isinstance(tts_error, AdmissionRejected):
+                trace_status = "rejected"
+                yield chat_history, chat_history, None, prescription_path, _busy_message(tts_error)
+                return
+            if isinstance(tts_error, deadlines.DeadlineExceeded):
+                trace_status = "timeout"
+                yield chat_history, chat_history, None, prescription_path, _timeout_message(tts_error)
+                return
+            if tts_error is not None:
+                yield chat_history, chat_history, None, prescription_path, f"Error generating voice response: {str(tts_error)}"
+                return
+            # The audio has already been streamed to the player chunk by chunk
+            response_audio = None
+        else:
+            # The TTS router falls back from ElevenLabs to gTTS on its own
+            try:
+                async with stage_limiters["tts"]:
+                    with deadlines.stage("tts"):
+                        await _run_stage(
+                            stage_timings,
+                            "tts",
+                            text_to_speech,
+                            input_text=doctor_response,
+                            output_filepath=temp_response_path
+                        )
+            except AdmissionRejected as e:
+                trace_status = "rejected"
+                prescription_path = await prescription_task if prescription_task else None
+                yield chat_history, chat_history, None, prescription_path, _busy_message(e)
+                return
+            except deadlines.DeadlineExceeded as e:
+                trace_status = "timeout"
+                prescription_path = await prescription_task if prescription_task else None
+                yield chat_history, chat_history, None, prescription_path, _timeout_message(e)
+                return
+            except Exception as e:
+                prescription_path = await prescription_task if prescription_task else None
+                yield chat_history, chat_history, None, prescription_path, f"Error generating voice response: {str(e)}"
+                return
+            prescription_path = await prescription_task if prescription_task else None
+            response_audio = temp_response_path
 
-        return chat_history, chat_history, temp_response_path, prescription_path, ""
+        # Play the audio on this machine too when running locally
+        if LOCAL_PLAYBACK:
+            try:
+                play_audio(temp_response_path)
+            except Exception as e:
+                yield chat_history, chat_history, response_audio, prescription_path, f"Error playing audio: {str(e)}"
+                return
 
+        yield chat_history, chat_history, response_audio, prescription_path, ""
+
+    except AdmissionRejected as e:
+        trace_status = "rejected"
+        # Drop the placeholder reply if the request never got to the model
+        if chat_history and chat_history[-1]["role"] == "assistant" and not chat_history[-1]["content"]:
+            chat_history.pop()
+        yield chat_history, chat_history, None, None, _busy_message(e)
+    
+    except deadlines.DeadlineExceeded as e:
+        trace_status = "timeout"
+        if chat_history and chat_history[-1]["role"] == "assistant" and not chat_history[-1]["content"]:
+            chat_history.pop()
+        yield chat_history, chat_history, None, None, _timeout_message(e)
+    
     except Exception as e:
-        return chat_history, chat_history, None, None, f"An error occurred: {str(e)}"
+        trace_status = "error"
+        yield chat_history, chat_history, None, None, f"An error occurred: {str(e)}"
+    
+    finally:
+        # Make sure the TTS pipeline stops waiting for sentences
+        sentence_queue.put(None)
+        stage_timings["total"] = time.perf_counter() - pipeline_start
+        logging.info("Stage timings: " + ", ".join(f"{name}={elapsed:.3f}s" for name, elapsed in stage_timings.items()))
+        for observer in stage_timing_observers:
+            observer(stage_timings)
+        tracing.finish_trace(trace, trace_status, stage_timings=stage_timings)
+        deadlines.clear()
+        # Queued for the background writer; files are hashed and copied off the request path
+        if CONSULTATION_LOG_ENABLED and speech_to_text_output is not None:
+            files = [("audio_input", audio_filepath)] + [("image", path) for path in image_filepaths or []]
+            if temp_response_path and os.path.exists(temp_response_path) and os.path.getsize(temp_response_path):
+                files.append(("response_audio", temp_response_path))
+            files.append(("prescription", prescription_path))
+            consultation_log.record(
+                session_id=session_id,
+                patient_name=patient_name,
+                transcript=speech_to_text_output,
+                response=doctor_response,
+                status=trace_status,
+                stage_timings=stage_timings,
+                files=files,
+            )
+
+# Operational stats are served next to /metrics and /traces on the metrics server, which
+# binds to METRICS_HOST; traces carry session ids, so none of this goes on the public app
+# Queue depth, wait times and rejections per stage
+tracing.add_status_page("/admission", admission_metrics)
+# Bytes and files held by the artifact store, and how much the sweeper removed
+tracing.add_status_page("/artifacts", artifacts.metrics)
+# Hits and misses per result cache (vision, transcription, speech)
+tracing.add_status_page("/caches", cache_stats)
+# Error rate, p95 latency and circuit state of every provider
+tracing.add_status_page("/providers", router_stats)
+# Worker process count and calls routed to each (see WORKER_PROCESSES)
+tracing.add_status_page("/workers", workers.stats)
+# Speculative image analyses started on upload and how many a submit used
+tracing.add_status_page("/speculation", speculative_vision.metrics)
 
 # Create the interface with improved UI
-with gr.Blocks(theme=gr.themes.Soft()) as iface:
+# Gradio copies returned files into its own cache; age those out on the same schedule
+with gr.Blocks(theme=gr.themes.Soft(), delete_cache=(int(ARTIFACT_SWEEP_INTERVAL), int(ARTIFACT_MAX_AGE))) as iface:
     gr.Markdown("# AI Medical Assistant")
     gr.Markdown("""Welcome to your AI Medical Assistant. This tool is for educational purposes only and should not replace professional medical advice.
     
@@ -218,7 +569,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as iface:
        - The AI doctor will remember your previous conversation
     
     3. The conversation history will show your entire interaction
-    4. A prescription will be generated automatically
+    4. Click Generate Prescription to download a prescription for the latest assessment
     
     Note: Always consult with a healthcare professional for proper medical advice.""")
     
@@ -234,7 +585,8 @@ with gr.Blocks(theme=gr.themes.Soft()) as iface:
         with gr.Column(scale=1):
             # Output section
             chatbot = gr.Chatbot(label="Conversation History", height=400, type="messages")
-            audio_output = gr.Audio(label="Doctor's Voice Response")
+            audio_output = gr.Audio(label="Doctor's Voice Response", streaming=True, autoplay=True, interactive=False)
+            prescription_btn = gr.Button("Generate Prescription", variant="secondary")
             prescription_output = gr.File(label="Download Prescription")
             status = gr.Textbox(label="Status/Error Messages")
     
@@ -243,10 +595,44 @@ with gr.Blocks(theme=gr.themes.Soft()) as iface:
     def clear_audio():
         return None
     
+    async def prepare_prescription(chat_history, patient_name, request: gr.Request = None):
+        session_id = request.session_hash if request is not None else None
+        # Only the latest assessment goes on the prescription
+        for message in reversed(chat_history):
+            if message["role"] == "assistant" and message["content"]:
+                trace = tracing.start_trace("prescription", session_id=session_id)
+                try:
+                    path = await _render_prescription({}, message["content"], patient_name or "Patient", session_id)
+                    tracing.finish_trace(trace, "ok" if path else "error")
+                    return path
+                except AdmissionRejected as e:
+                    tracing.finish_trace(trace, "rejected")
+                    raise gr.Error(f"The service is busy: {str(e)}. Please try again shortly.")
+        return None
+    
     submit_btn.click(
         fn=process_inputs,
         inputs=[audio_input, image_input, chat_history, patient_name],
-        outputs=[chatbot, chat_history, audio_output, prescription_output, status]
+        outputs=[chatbot, chat_history, audio_output, prescription_output, status],
+        concurrency_limit=GRADIO_CONCURRENCY
+    )
+    
+    # Start on the images while the patient is still recording
+    image_input.change(
+        fn=speculate_on_upload,
+        inputs=[image_input],
+        outputs=None,
+        show_progress="hidden",
+        trigger_mode="always_last",
+        # Only schedules background work; the speculation budget and vision stage limit govern it
+        concurrency_limit=None
+    )
+    
+    prescription_btn.click(
+        fn=prepare_prescription,
+        inputs=[chat_history, patient_name],
+        outputs=[prescription_output],
+        concurrency_limit=PDF_CONCURRENCY
     )
     
     clear_btn.click(
@@ -256,6 +642,13 @@ with gr.Blocks(theme=gr.themes.Soft()) as iface:
     )
 
 if __name__ == "__main__":
+    # Fork the worker processes before the server starts its threads
+    workers.start()
+    # Sweeps once now, so leftovers from earlier runs are cleaned up and counted from the start
+    artifacts.start_sweeper()
+    if tracing.METRICS_PORT:
+        tracing.start_metrics_server(tracing.METRICS_PORT)
+    iface.queue(max_size=GRADIO_MAX_QUEUE)
     iface.launch(debug=True, share=True)
 
 #http://127.0.0.1:7860
\ No newline at end of file
@@ -0,0 +1,114 @@
+import os
+import io
+import base64
+import hashlib
+import logging
+from dataclasses import dataclass
+from PIL import Image, ImageOps
+
+# Images are downscaled so their longest edge fits IMAGE_MAX_EDGE before upload
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+# Files already small enough, upright and in a supported format are sent untouched
+IMAGE_PASSTHROUGH_BYTES = int(os.environ.get("IMAGE_PASSTHROUGH_BYTES", str(256 * 1024)))
+
+PASSTHROUGH_FORMATS = {"JPEG", "PNG", "WEBP"}
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Multiple of 3 so each chunk base64-encodes without padding
+_BASE64_CHUNK_BYTES = 3 * 64 * 1024
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """A base64 payload ready for a data URL, plus what is needed to label and cache it."""
+    data: str
+    mime_type: str
+    sha256: str
+    width: int
+    height: int
+    
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.data}"
+
+def _stream_base64(source, hasher):
+    """
+    Base64-encode a binary stream chunk by chunk, updating a hash along the way.
+    
+    Args:
+        source: A readable binary file object
+        hasher: A hashlib object fed with the raw bytes
+        
+    Returns:
+        str: The base64 encoding of everything read from source
+    """
+    output = io.StringIO()
+    while True:
+        chunk = source.read(_BASE64_CHUNK_BYTES)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        output.write(base64.b64encode(chunk).decode('ascii'))
+    return output.getvalue()
+
+def preprocess_image(image_path, max_edge=None, quality=None):
+    """
+    Normalize an image for the vision model and base64-encode it.
+    
+    The image is rotated according to its EXIF orientation, downscaled so its
+    longest edge is at most max_edge and re-encoded (JPEG, or PNG when it has
+    transparency). Small upright JPEG/PNG/WebP files are streamed as-is.
+    
+    Args:
+        image_path (str): Path to the image file
+        max_edge (int): Maximum width or height in pixels, defaults to IMAGE_MAX_EDGE
+        quality (int): JPEG quality used when re-encoding, defaults to IMAGE_JPEG_QUALITY
+        
+    Returns:
+        EncodedImage: The encoded image with its MIME type, SHA-256 and dimensions
+        
+    Raises:
+        FileNotFoundError: If the image file doesn't exist
+        ValueError: If the file is not a valid image
+    """
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    quality = quality or IMAGE_JPEG_QUALITY
+    
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image file not found: {image_path}")
+    
+    try:
+        image = Image.open(image_path)
+    except Exception as e:
+        raise ValueError(f"Not a valid image: {image_path}") from e
+    
+    with image:
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        hasher = hashlib.sha256()
+        
+        if (image.format in PASSTHROUGH_FORMATS
+                and orientation == 1
+                and max(image.size) <= max_edge
+                and os.path.getsize(image_path) <= IMAGE_PASSTHROUGH_BYTES):
+            mime_type = Image.MIME[image.format]
+            width, height = image.size
+            with open(image_path, "rb") as image_file:
+                data = _stream_base64(image_file, hasher)
+            return EncodedImage(data, mime_type, hasher.hexdigest(), width, height)
+        
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(buffer, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+        width, height = image.size
+    
+    size = buffer.tell()
+    buffer.seek(0)
+    data = _stream_base64(buffer, hasher)
+    logging.info(f"Preprocessed {image_path}: {os.path.getsize(image_path)} -> {size} bytes, {width}x{height} {mime_type}")
+    return EncodedImage(data, mime_type, hasher.hexdigest(), width, height)
@@ -5,16 +5,21 @@ load_dotenv()
 #Setup Audio recorder (ffmpeg & portaudio)
 # ffmpeg, portaudio, pyaudio
 import logging
-import speech_recognition as sr
-from pydub import AudioSegment
 from io import BytesIO
-from groq import Groq
+from concurrent.futures import ThreadPoolExecutor
+from clients import get_groq_client
+from result_cache import ResultCache, file_fingerprint, make_key
+from audio_preprocessing import preprocess_audio
+from provider_router import ProviderRouter
+from admission import STAGE_LIMITS
+from worker_pool import workers
+from deadlines import call_with_retry
+import tracing
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Checked when the first request is made, so importing this module never fails
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY environment variable is not set")
 
 def record_audio(file_path, timeout=20, phrase_time_limit=None):
     """
@@ -31,6 +36,10 @@ def record_audio(file_path, timeout=20, phrase_time_limit=None):
     Raises:
         Exception: If there's an error during recording
     """
+    # Imported here so the web app does not need PortAudio/PyAudio just to start
+    import speech_recognition as sr
+    from pydub import AudioSegment
+    
     recognizer = sr.Recognizer()
     
     try:
@@ -58,20 +67,44 @@ def record_audio(file_path, timeout=20, phrase_time_limit=None):
         logging.error(f"An error occurred during recording: {str(e)}")
         return False
 
-audio_filepath="patient_voice_test_for_patient.mp3"
-record_audio(file_path=audio_filepath)
-
 #Setup Speech to text–STT–model for transcription
 stt_model="whisper-large-v3"
 
-def transcribe_with_groq(stt_model, audio_filepath, GROQ_API_KEY):
+# Transcriptions keyed by audio content, model and language
+transcription_cache = ResultCache("transcription")
+
+# Trim and compress recordings locally before uploading them
+AUDIO_PREPROCESSING = os.environ.get("AUDIO_PREPROCESSING", "true").lower() in ("1", "true", "yes")
+# Maximum chunks of a long recording transcribed at once
+STT_CHUNK_CONCURRENCY = int(os.environ.get("STT_CHUNK_CONCURRENCY", "4"))
+
+def _transcribe_file(client, stt_model, audio_file):
+    def attempt(timeout):
+        if hasattr(audio_file, "seek"):
+            # A retry has to upload the file from the start again
+            audio_file.seek(0)
+        return client.audio.transcriptions.create(
+            model=stt_model,
+            file=audio_file,
+            language="en",
+            timeout=timeout
+        )
+    
+    return call_with_retry("groq.transcription", attempt).text
+
+def transcribe_with_groq(stt_model, audio_filepath, GROQ_API_KEY, use_cache=True):
     """
     Transcribe audio using the Groq API.
     
+    The recording is trimmed, resampled and compressed first (see
+    audio_preprocessing); long recordings are split at pauses and the chunks
+    are transcribed in parallel.
+    
     Args:
         stt_model (str): The speech-to-text model to use
         audio_filepath (str): Path to the audio file to transcribe
         GROQ_API_KEY (str): Groq API key
+        use_cache (bool): Return a cached transcription for identical audio, and cache new ones
         
     Returns:
         str: The transcribed text
@@ -80,20 +113,85 @@ def transcribe_with_groq(stt_model, audio_filepath, GROQ_API_KEY):
         Exception: If there's an error during transcription
     """
     try:
-        if not os.path.exists(audio_filepath):
-            raise FileNotFoundError(f"Audio file not found: {audio_filepath}")
+        with tracing.span("stt.transcribe", model=stt_model) as span:
+            if not os.path.exists(audio_filepath):
+                raise FileNotFoundError(f"Audio file not found: {audio_filepath}")
+                
+            prepared = None
+            if AUDIO_PREPROCESSING:
+                try:
+                    prepared = workers.call(None, preprocess_audio, audio_filepath)
+                except Exception as e:
+                    logging.error(f"Error preprocessing audio, uploading it unchanged: {str(e)}")
             
-        client = Groq(api_key=GROQ_API_KEY)
-        
-        with open(audio_filepath, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-                model=stt_model,
-                file=audio_file,
-                language="en"
-            )
+            span.set(bytes_in=os.path.getsize(audio_filepath), bytes_out=prepared.size if prepared else None,
+                     chunks=len(prepared.chunks) if prepared else 1)
+            
+            if use_cache:
+                audio_hash = prepared.sha256 if prepared else file_fingerprint(audio_filepath)
+                cache_key = make_key(stt_model, "en", audio_hash)
+                cached = transcription_cache.get(cache_key)
+                span.set(cache_hit=cached is not None)
+                if cached is not None:
+                    logging.info("Transcription cache hit")
+                    return cached
+            
+            client = get_groq_client(GROQ_API_KEY)
+            
+            if prepared is None:
+                with open(audio_filepath, "rb") as audio_file:
+                    text = _transcribe_file(client, stt_model, audio_file)
+            elif len(prepared.chunks) == 1:
+                chunk = prepared.chunks[0]
+                text = _transcribe_file(client, stt_model, (chunk.filename, chunk.data))
+            else:
+                with ThreadPoolExecutor(max_workers=STT_CHUNK_CONCURRENCY) as executor:
+                    # Chunks keep the request's deadline and trace in the pool's threads
+                    texts = executor.map(
+                        tracing.propagate(lambda chunk: _transcribe_file(client, stt_model, (chunk.filename, chunk.data))),
+                        prepared.chunks
+                    )
+                    text = " ".join(part.strip() for part in texts if part)
+                
+            span.set(characters=len(text or ""))
+            if use_cache:
+                transcription_cache.set(cache_key, text)
+            return text
             
-        return transcription.text
-        
     except Exception as e:
         logging.error(f"Error transcribing audio: {str(e)}")
         raise
+
+# Speech-to-text models in order of preference; later ones are fallbacks
+STT_MODELS = os.environ.get("STT_MODELS", "whisper-large-v3,whisper-large-v3-turbo").split(",")
+STT_HEDGE = os.environ.get("STT_HEDGE", "false").lower() in ("1", "true", "yes")
+
+def _stt_provider(model):
+    return lambda audio_filepath: transcribe_with_groq(model, audio_filepath, GROQ_API_KEY)
+
+stt_router = ProviderRouter(
+    "stt",
+    [(model, _stt_provider(model)) for model in STT_MODELS],
+    hedge=STT_HEDGE,
+    hedge_workers=STAGE_LIMITS["stt"][0]
+)
+
+def transcribe_audio(audio_filepath):
+    """
+    Transcribe audio with the healthiest speech-to-text model, falling back to the others.
+    
+    Args:
+        audio_filepath (str): Path to the audio file to transcribe
+        
+    Returns:
+        str: The transcribed text
+        
+    Raises:
+        AllProvidersFailedError: If every model failed
+    """
+    return stt_router.call(audio_filepath)
+
+if __name__ == "__main__":
+    audio_filepath="patient_voice_test_for_patient.mp3"
+    if record_audio(file_path=audio_filepath):
+        print(transcribe_with_groq(stt_model, audio_filepath, GROQ_API_KEY))
@@ -0,0 +1,107 @@
+import io
+import logging
+from datetime import datetime
+from functools import lru_cache
+from xml.sax.saxutils import escape
+from artifact_store import artifacts
+from worker_pool import workers
+import tracing
+
+@lru_cache(maxsize=1)
+def _get_styles():
+    """
+    Build the paragraph styles used by every prescription, once per process.
+    
+    Returns:
+        dict: ParagraphStyle objects keyed by "header", "date", "content" and "footer"
+    """
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    
+    styles = getSampleStyleSheet()
+    return {
+        "header": ParagraphStyle(
+            'CustomHeader',
+            parent=styles['Heading1'],
+            fontSize=24,
+            spaceAfter=30
+        ),
+        "date": ParagraphStyle(
+            'DateStyle',
+            parent=styles['Normal'],
+            fontSize=12,
+            spaceAfter=20
+        ),
+        "content": ParagraphStyle(
+            'ContentStyle',
+            parent=styles['Normal'],
+            fontSize=12,
+            spaceAfter=12
+        ),
+        "footer": ParagraphStyle(
+            'FooterStyle',
+            parent=styles['Normal'],
+            fontSize=10,
+            spaceBefore=30
+        ),
+    }
+
+def render_prescription(doctor_response, patient_name="Patient"):
+    """
+    Render a prescription PDF into memory.
+    
+    Args:
+        doctor_response (str): The doctor's assessment to include
+        patient_name (str): Name printed on the prescription
+        
+    Returns:
+        bytes: The PDF document
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    
+    styles = _get_styles()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    
+    # Paragraph parses its text as markup, so escape model output and keep line breaks
+    content = escape(doctor_response).replace("\n", "<br/>")
+    
+    story = [
+        Paragraph("Medical Prescription", styles["header"]),
+        Paragraph(f"Date: {datetime.now().strftime('%Y-%m-%d')}", styles["date"]),
+        Paragraph(f"Patient: {escape(patient_name or 'Patient')}", styles["date"]),
+        Spacer(1, 20),
+        Paragraph(content, styles["content"]),
+        Spacer(1, 50),
+        Paragraph("This is a computer-generated prescription for educational purposes only.", styles["footer"]),
+        Paragraph("Please consult with a healthcare professional for proper medical advice.", styles["footer"]),
+    ]
+    
+    doc.build(story)
+    return buffer.getvalue()
+
+def generate_prescription(doctor_response, patient_name="Patient", session_id=None):
+    """
+    Generate a PDF prescription from the doctor's response and store it as a session artifact.
+    
+    Args:
+        doctor_response (str): The doctor's assessment to include
+        patient_name (str): Name printed on the prescription
+        session_id (str): Session whose artifact namespace the PDF is written to
+        
+    Returns:
+        str | None: Path of the PDF, or None if rendering failed
+    """
+    try:
+        with tracing.span("prescription.render") as span:
+            pdf = workers.call(session_id, render_prescription, doctor_response, patient_name)
+            span.set(bytes_in=len(doctor_response or ""), bytes_out=len(pdf))
+            
+            prescription_path = artifacts.new_path(session_id, "prescription.pdf")
+            with open(prescription_path, "wb") as f:
+                f.write(pdf)
+            return prescription_path
+        
+    except Exception as e:
+        logging.error(f"Error generating prescription: {str(e)}")
+        return None
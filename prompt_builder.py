@@ -0,0 +1,127 @@
+import os
+import re
+import json
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from result_cache import fingerprint
+
+# Upper bound on the text part of a vision prompt (system prompt + conversation)
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "4000"))
+
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Words, numbers and individual punctuation marks, roughly how BPE tokenizers split text
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """
+    Count the tokens a piece of text will use, locally and without a tokenizer download.
+    
+    Short words are one token and longer ones one per four characters, which
+    tracks Llama-style BPE tokenizers closely for English prose. Results are
+    memoized, so history turns are only counted once.
+    
+    Args:
+        text (str): The text to measure
+    
+    Returns:
+        int: Approximate token count
+    """
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PIECES.findall(text))
+
+@dataclass(frozen=True)
+class Prompt:
+    """
+    Chat messages for one model call.
+    
+    messages starts with the system message and ends with the current user
+    turn; images are attached to that last message when the request is sent.
+    """
+    messages: tuple
+    tokens: int
+    fingerprint: str
+    
+    @property
+    def text(self):
+        """The current user turn."""
+        return self.messages[-1]["content"]
+
+class PromptBuilder:
+    """
+    Builds prompts with a stable prefix: the system message, then the conversation turns in order.
+    
+    Providers that cache prompt prefixes can reuse everything up to the latest
+    turn, because earlier messages are sent byte-for-byte identically on
+    every turn of a session.
+    """
+    
+    def __init__(self, system_prompt, token_budget=PROMPT_TOKEN_BUDGET):
+        """
+        Args:
+            system_prompt (str): Instructions sent as the system message
+            token_budget (int): Maximum estimated tokens of text per prompt
+        """
+        self.system_message = {"role": "system", "content": system_prompt.strip()}
+        self.system_tokens = count_tokens(self.system_message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        self.token_budget = token_budget
+    
+    def build(self, history):
+        """
+        Build the prompt for the next model call.
+        
+        Args:
+            history (list[dict]): Conversation messages ({"role", "content"}), oldest first,
+                ending with the current user turn
+        
+        Returns:
+            Prompt: The messages with their estimated token count
+        """
+        history = list(history)
+        turn_tokens = [count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in history]
+        tokens = self.system_tokens + sum(turn_tokens)
+        
+        # Normally the session store keeps history within budget; drop the oldest turns if it did not
+        dropped = 0
+        while tokens > self.token_budget and len(history) - dropped > 1:
+            tokens -= turn_tokens[dropped]
+            dropped += 1
+        if dropped:
+            logging.warning(f"Prompt over budget, dropped {dropped} oldest message(s)")
+            history = history[dropped:]
+        
+        messages = (self.system_message, *history)
+        return Prompt(
+            messages=messages,
+            tokens=tokens,
+            fingerprint=fingerprint(json.dumps(messages, sort_keys=True)),
+        )
+    
+    def build_question(self, question):
+        """
+        Build a prompt for a single question with no earlier conversation.
+        
+        Args:
+            question (str): The patient's question
+        
+        Returns:
+            Prompt: The messages with their estimated token count
+        """
+        return self.build([{"role": "user", "content": question}])
+    
+    def extend_question(self, prompt, text):
+        """
+        Rebuild a prompt with extra text appended to its current user turn.
+        
+        Args:
+            prompt (Prompt): A prompt from build or build_question
+            text (str): Context to add after the user's question
+        
+        Returns:
+            Prompt: The prompt with the extended last message
+        """
+        history = list(prompt.messages[1:])
+        history[-1] = {**history[-1], "content": f"{history[-1]['content']}\n\n{text}"}
+        return self.build(history)
@@ -0,0 +1,396 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from deadlines import DeadlineExceeded, check, is_transient
+import tracing
+
+# Circuit breaker: open after this many consecutive failures, or when the
+# error rate over the rolling window exceeds the threshold
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", "50"))
+ROUTER_FAILURE_THRESHOLD = int(os.environ.get("ROUTER_FAILURE_THRESHOLD", "3"))
+ROUTER_ERROR_RATE_THRESHOLD = float(os.environ.get("ROUTER_ERROR_RATE_THRESHOLD", "0.5"))
+ROUTER_MIN_SAMPLES = int(os.environ.get("ROUTER_MIN_SAMPLES", "10"))
+# Seconds an open circuit waits before letting a trial request through
+ROUTER_COOLDOWN = float(os.environ.get("ROUTER_COOLDOWN", "30"))
+# Hedge deadline bounds (seconds); the primary's rolling p95 is used in between
+ROUTER_HEDGE_MIN_DELAY = float(os.environ.get("ROUTER_HEDGE_MIN_DELAY", "0.5"))
+ROUTER_HEDGE_MAX_DELAY = float(os.environ.get("ROUTER_HEDGE_MAX_DELAY", "10"))
+ROUTER_HEDGE_DEFAULT_DELAY = float(os.environ.get("ROUTER_HEDGE_DEFAULT_DELAY", "3"))
+
+class AllProvidersFailedError(Exception):
+    """Raised when every provider of a router failed or had its circuit open."""
+
+class CircuitOpenError(Exception):
+    """Raised when a provider is skipped because its circuit is open."""
+
+# Client errors that still say the provider is unusable: bad or revoked keys, unpaid or exhausted quota
+ACCOUNT_FAILURE_STATUSES = {401, 402, 403}
+ACCOUNT_FAILURE_MARKERS = ("quota_exceeded", "invalid_api_key", "unauthorized", "payment_required")
+
+def is_provider_failure(error):
+    """
+    Whether a failed call says the provider is unhealthy.
+    
+    Rate limits, server errors, timeouts and dropped connections do, as do
+    authentication and quota errors (ElevenLabs reports an exhausted quota as
+    a 401 with "quota_exceeded"). Other client errors (bad input, missing
+    files) say nothing about the provider and do not count towards its
+    circuit breaker.
+    
+    Args:
+        error (Exception): The exception raised by the provider
+        
+    Returns:
+        bool: True if the failure should be recorded against the provider
+    """
+    if is_transient(error):
+        return True
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int) and (status >= 500 or status in ACCOUNT_FAILURE_STATUSES):
+        return True
+    body = str(getattr(error, "body", "") or "").lower()
+    return any(marker in body for marker in ACCOUNT_FAILURE_MARKERS)
+
+class ProviderStats:
+    """Rolling latency and error record of one provider, plus its circuit breaker state."""
+    
+    def __init__(self, window=ROUTER_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+    
+    def p95(self):
+        latencies = sorted(latency for latency, ok in self.samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+    
+    def error_rate(self):
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+    
+    def snapshot(self):
+        return {
+            "requests": len(self.samples),
+            "error_rate": round(self.error_rate(), 3),
+            "p95": self.p95(),
+            "consecutive_failures": self.consecutive_failures,
+            "circuit": "open" if self.opened_at is not None else "closed",
+        }
+
+# Every router created in this process, by name, for router_stats()
+_routers = {}
+
+class ProviderRouter:
+    """
+    Route calls across interchangeable providers in preference order.
+    
+    Each provider is a plain callable, so stubs can be swapped in for testing.
+    Failing providers have their circuit opened and are skipped until a
+    cooldown has passed, after which a single trial request is let through.
+    With hedging enabled, the first provider runs on a thread of its own; if
+    it has not answered by its rolling p95 latency, a backup request is
+    started on the next provider in a small pool, and whichever of the two
+    succeeds first is used.
+    """
+    
+    def __init__(self, name, providers, hedge=False, hedge_workers=8, window=ROUTER_WINDOW,
+                 failure_threshold=ROUTER_FAILURE_THRESHOLD, error_rate_threshold=ROUTER_ERROR_RATE_THRESHOLD,
+                 min_samples=ROUTER_MIN_SAMPLES, cooldown=ROUTER_COOLDOWN):
+        """
+        Args:
+            name (str): Name used in logs, e.g. "tts"
+            providers (list[tuple[str, callable]]): (provider name, function) pairs, most preferred first
+            hedge (bool): Send a backup request when the first provider is slow
+            hedge_workers (int): Backup requests that may run at once, normally the stage's concurrency
+        """
+        self.name = name
+        self.providers = list(providers)
+        self.hedge = hedge
+        self.hedge_workers = max(hedge_workers, 1)
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self._stats = {provider_name: ProviderStats(window) for provider_name, _ in self.providers}
+        self._lock = threading.Lock()
+        self._executor = None
+        _routers[name] = self
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix=f"{self.name}-hedge")
+            return self._executor
+    
+    def _available(self):
+        """Providers that may be tried now, in preference order."""
+        now = time.monotonic()
+        available = []
+        with self._lock:
+            for provider_name, func in self.providers:
+                stats = self._stats[provider_name]
+                if stats.opened_at is None or (now - stats.opened_at >= self.cooldown and not stats.trial_in_flight):
+                    available.append((provider_name, func))
+        return available
+    
+    def _begin(self, provider_name):
+        """Claim the single trial request of a half-open circuit, if it is open."""
+        with self._lock:
+            stats = self._stats[provider_name]
+            if stats.opened_at is None:
+                return
+            if stats.trial_in_flight or time.monotonic() - stats.opened_at < self.cooldown:
+                raise CircuitOpenError(f"{self.name} provider {provider_name} circuit is open")
+            stats.trial_in_flight = True
+    
+    def record(self, provider_name, latency, ok):
+        """
+        Record the outcome of a call and update the provider's circuit.
+        
+        Args:
+            provider_name (str): The provider that was called
+            latency (float): Seconds the call took
+            ok (bool): Whether it succeeded
+        """
+        with self._lock:
+            stats = self._stats[provider_name]
+            stats.samples.append((latency, ok))
+            stats.trial_in_flight = False
+            if ok:
+                stats.consecutive_failures = 0
+                if stats.opened_at is not None:
+                    logging.info(f"{self.name} provider {provider_name} recovered, closing circuit")
+                stats.opened_at = None
+                return
+            stats.consecutive_failures += 1
+            failing = (stats.consecutive_failures >= self.failure_threshold
+                       or (len(stats.samples) >= self.min_samples and stats.error_rate() > self.error_rate_threshold))
+            if failing:
+                if stats.opened_at is None:
+                    logging.error(f"{self.name} provider {provider_name} is failing, opening circuit")
+                stats.opened_at = time.monotonic()
+    
+    def _release(self, provider_name):
+        """Give up a half-open circuit's trial without recording an outcome."""
+        with self._lock:
+            self._stats[provider_name].trial_in_flight = False
+    
+    def _timed(self, provider_name, func, args, kwargs):
+        self._begin(provider_name)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except DeadlineExceeded:
+            # Running out of request time says nothing about the provider's health
+            self._release(provider_name)
+            raise
+        except Exception as e:
+            if is_provider_failure(e):
+                self.record(provider_name, time.perf_counter() - start, False)
+            else:
+                self._release(provider_name)
+            raise
+        self.record(provider_name, time.perf_counter() - start, True)
+        return result
+    
+    def _start(self, provider_name, func, args, kwargs):
+        """Run a call on a thread of its own rather than the pool, returning a future for its result."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        timed = tracing.propagate(self._timed)
+        
+        def run():
+            try:
+                future.set_result(timed(provider_name, func, args, kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        
+        threading.Thread(target=run, name=f"{self.name}-{provider_name}", daemon=True).start()
+        return future
+    
+    def hedge_delay(self, provider_name):
+        """
+        How long to wait for a provider before hedging.
+        
+        Args:
+            provider_name (str): The primary provider
+            
+        Returns:
+            float: Its rolling p95 latency clamped to the configured bounds
+        """
+        with self._lock:
+            p95 = self._stats[provider_name].p95()
+        if p95 is None:
+            return ROUTER_HEDGE_DEFAULT_DELAY
+        return min(max(p95, ROUTER_HEDGE_MIN_DELAY), ROUTER_HEDGE_MAX_DELAY)
+    
+    def call(self, *args, **kwargs):
+        """
+        Call the best available provider, falling back (or hedging) to the others.
+        
+        Returns:
+            The first successful provider's return value
+            
+        Raises:
+            AllProvidersFailedError: If no provider succeeded
+            DeadlineExceeded: If the request deadline passed before a provider succeeded
+        """
+        return self.route(*args, **kwargs)[1]
+    
+    def route(self, *args, **kwargs):
+        """
+        Like call, but also report which provider answered.
+        
+        Returns:
+            tuple: (provider name, return value) of the first successful provider
+            
+        Raises:
+            AllProvidersFailedError: If no provider succeeded
+            DeadlineExceeded: If the request deadline passed before a provider succeeded
+        """
+        candidates = self._available()
+        errors = []
+        
+        while candidates:
+            # Falling back is pointless once the request is out of time
+            check(f"trying {self.name} providers")
+            provider_name, func = candidates.pop(0)
+            if not (self.hedge and candidates):
+                try:
+                    return provider_name, self._timed(provider_name, func, args, kwargs)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    logging.error(f"{self.name} provider {provider_name} failed: {str(e)}")
+                    errors.append(e)
+                continue
+            
+            # Only the backup goes through the pool, so the primary is never queued behind other calls
+            primary = self._start(provider_name, func, args, kwargs)
+            racing = {primary: provider_name}
+            backup_name, backup_func = candidates.pop(0)
+            if wait([primary], timeout=self.hedge_delay(provider_name)).not_done:
+                logging.info(f"{self.name} provider {provider_name} is slow, hedging with {backup_name}")
+                backup = self._get_executor().submit(
+                    tracing.propagate(self._timed), backup_name, backup_func, args, kwargs
+                )
+                racing[backup] = backup_name
+            else:
+                # The primary answered in time, so the backup is just the next fallback
+                candidates.insert(0, (backup_name, backup_func))
+            
+            pending = set(racing)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except DeadlineExceeded:
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    except Exception as e:
+                        logging.error(f"{self.name} provider {racing[future]} failed: {str(e)}")
+                        errors.append(e)
+                        continue
+                    # A backup still queued for a pool slot is dropped; one already running finishes in the background
+                    for other in pending:
+                        other.cancel()
+                    return racing[future], result
+        
+        raise AllProvidersFailedError(
+            f"All {self.name} providers failed or are unavailable: " + "; ".join(str(e) for e in errors)
+        )
+    
+    def call_provider(self, provider_name, *args, **kwargs):
+        """
+        Call one named provider without falling back, still recording its health.
+        
+        Args:
+            provider_name (str): The provider to call, e.g. the one an earlier route() picked
+            
+        Returns:
+            The provider's return value
+            
+        Raises:
+            CircuitOpenError: If the provider's circuit is open
+            Exception: Whatever the provider raised
+        """
+        func = dict(self.providers)[provider_name]
+        check(f"calling {self.name} provider {provider_name}")
+        return self._timed(provider_name, func, args, kwargs)
+    
+    def stream(self, *args, **kwargs):
+        """
+        Stream from the best available provider, whose functions must be generators.
+        
+        A provider that fails before producing its first item is recorded as
+        failed and the next one is tried; once output has started the stream
+        is committed to that provider. Latency is measured to the first item.
+        
+        Yields:
+            The items of the first provider that starts streaming
+            
+        Raises:
+            AllProvidersFailedError: If no provider could start a stream
+            DeadlineExceeded: If the request deadline passed before a stream started
+        """
+        errors = []
+        for provider_name, func in self._available():
+            check(f"trying {self.name} providers")
+            try:
+                self._begin(provider_name)
+            except CircuitOpenError as e:
+                errors.append(e)
+                continue
+            start = time.perf_counter()
+            try:
+                iterator = iter(func(*args, **kwargs))
+                first = next(iterator)
+            except StopIteration:
+                self.record(provider_name, time.perf_counter() - start, True)
+                return
+            except DeadlineExceeded:
+                self._release(provider_name)
+                raise
+            except Exception as e:
+                if is_provider_failure(e):
+                    self.record(provider_name, time.perf_counter() - start, False)
+                else:
+                    self._release(provider_name)
+                logging.error(f"{self.name} provider {provider_name} failed: {str(e)}")
+                errors.append(e)
+                continue
+            self.record(provider_name, time.perf_counter() - start, True)
+            yield first
+            yield from iterator
+            return
+        
+        raise AllProvidersFailedError(
+            f"All {self.name} providers failed or are unavailable: " + "; ".join(str(e) for e in errors)
+        )
+    
+    def stats(self):
+        """
+        Report the rolling health of every provider.
+        
+        Returns:
+            dict: Per-provider request count, error rate, p95 latency and circuit state
+        """
+        with self._lock:
+            return {provider_name: stats.snapshot() for provider_name, stats in self._stats.items()}
+
+def router_stats() -> dict:
+    """
+    Report the rolling health of every provider of every router in this process.
+    
+    Returns:
+        dict: ProviderRouter.stats() of each router, by name
+    """
+    return {name: router.stats() for name, router in list(_routers.items())}
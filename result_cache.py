@@ -0,0 +1,254 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import shared_state
+
+# In-memory tier size (entries) per cache
+CACHE_MEMORY_ENTRIES = int(os.environ.get("CACHE_MEMORY_ENTRIES", "256"))
+# Optional on-disk tier; disabled unless CACHE_DIR is set
+CACHE_DIR = os.environ.get("CACHE_DIR")
+CACHE_TTL = float(os.environ.get("CACHE_TTL", str(24 * 3600)))
+CACHE_MAX_DISK_BYTES = int(os.environ.get("CACHE_MAX_DISK_BYTES", str(256 * 1024 * 1024)))
+# Also keep entries in the shared state backend when one is configured (SHARED_BACKEND)
+CACHE_SHARED = os.environ.get("CACHE_SHARED", "true").lower() in ("1", "true", "yes")
+
+def fingerprint(data):
+    """
+    Hash text or bytes into a stable hex digest.
+    
+    Args:
+        data (str | bytes): The content to fingerprint
+        
+    Returns:
+        str: SHA-256 hex digest
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def file_fingerprint(filepath):
+    """
+    Hash a file's contents without reading it into memory at once.
+    
+    Args:
+        filepath (str): Path to the file
+        
+    Returns:
+        str: SHA-256 hex digest of the file contents
+    """
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def make_key(*parts):
+    """Combine several key parts (model name, content hash, prompt fingerprint...) into one key."""
+    return fingerprint("\x1f".join(str(part) for part in parts))
+
+# Every cache created in this process, by name, for cache_stats()
+_caches = {}
+
+class ResultCache:
+    """
+    Tiered content-addressed cache for model results (str or bytes).
+    
+    The memory tier is an LRU of max_entries items. If a disk directory is
+    configured, entries are also written there and expire after ttl seconds;
+    when the directory grows past max_disk_bytes the oldest files are removed.
+    If a shared state backend is configured (SHARED_BACKEND), entries are also
+    stored there so every worker process benefits from the others' results.
+    """
+    
+    def __init__(self, name, max_entries=CACHE_MEMORY_ENTRIES, disk_dir=CACHE_DIR,
+                 ttl=CACHE_TTL, max_disk_bytes=CACHE_MAX_DISK_BYTES, shared=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else None
+        self.shared = CACHE_SHARED and shared_state.is_shared() if shared is None else shared
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        _caches[name] = self
+    
+    def _disk_path(self, key, value_type):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.{value_type}")
+    
+    def _read_disk(self, key):
+        for value_type in ("txt", "bin"):
+            path = self._disk_path(key, value_type)
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    return None
+                with open(path, "rb") as f:
+                    data = f.read()
+                return data.decode('utf-8') if value_type == "txt" else data
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logging.error(f"Error reading {self.name} cache entry: {str(e)}")
+                return None
+        return None
+    
+    def _write_disk(self, key, value):
+        value_type = "txt" if isinstance(value, str) else "bin"
+        data = value.encode('utf-8') if isinstance(value, str) else value
+        path = self._disk_path(key, value_type)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file first so readers never see a partial entry
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            # Overwriting an entry only adds the difference to the tier's size
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.error(f"Error writing {self.name} cache entry: {str(e)}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += len(data) - replaced
+            over_quota = self._disk_bytes > self.max_disk_bytes
+        if over_quota:
+            self._evict_disk()
+    
+    def _list_disk_entries(self):
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+    
+    def _scan_disk_bytes(self):
+        return sum(size for _, size, _ in self._list_disk_entries())
+    
+    def _evict_disk(self):
+        """Drop expired entries, then the oldest ones until the tier is back under 90% of its quota."""
+        entries = sorted(self._list_disk_entries())
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        target = self.max_disk_bytes * 0.9
+        for mtime, size, path in entries:
+            if total <= target and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                total -= size
+        with self._lock:
+            self._disk_bytes = total
+    
+    def get(self, key):
+        """
+        Look up a cached value.
+        
+        Args:
+            key (str): Cache key from make_key
+            
+        Returns:
+            str | bytes | None: The cached value, or None on a miss
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+        
+        value = self._read_disk(key) if self.disk_dir else None
+        if value is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(key, value)
+            return value
+        
+        value = self._read_shared(key) if self.shared else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+            self._remember(key, value)
+        return value
+    
+    def _read_shared(self, key):
+        try:
+            return shared_state.get_backend().get(f"cache:{self.name}", key)
+        except Exception as e:
+            logging.error(f"Error reading {self.name} shared cache entry: {str(e)}")
+            return None
+    
+    def _write_shared(self, key, value):
+        try:
+            shared_state.get_backend().set(f"cache:{self.name}", key, value, ttl=self.ttl)
+        except Exception as e:
+            logging.error(f"Error writing {self.name} shared cache entry: {str(e)}")
+    
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+    
+    def set(self, key, value):
+        """
+        Store a value in the memory tier and, if configured, on disk and in the shared backend.
+        
+        Args:
+            key (str): Cache key from make_key
+            value (str | bytes): The result to cache
+        """
+        with self._lock:
+            self._remember(key, value)
+        if self.disk_dir:
+            self._write_disk(key, value)
+        if self.shared:
+            self._write_shared(key, value)
+    
+    def stats(self):
+        """
+        Report hit/miss counters and tier sizes.
+        
+        Returns:
+            dict: Counters for memory, disk and shared hits and misses, plus entry and byte counts
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+def cache_stats() -> dict:
+    """
+    Report the hit/miss counters and sizes of every cache in this process.
+    
+    Returns:
+        dict: ResultCache.stats() of each cache, by name
+    """
+    return {name: cache.stats() for name, cache in list(_caches.items())}
@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+from prompt_builder import count_tokens
+import shared_state
+
+# Per-session limits; older turns are folded into a summary once the budget is exceeded
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET", "1500"))
+SESSION_SUMMARY_TOKENS = int(os.environ.get("SESSION_SUMMARY_TOKENS", "300"))
+SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", "1000"))
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "3600"))
+# Once over budget, fold turns until the rest fit in this fraction of it, so the
+# prompt prefix stays the same for several turns instead of shifting every turn
+SESSION_COMPACT_RATIO = float(os.environ.get("SESSION_COMPACT_RATIO", "0.5"))
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def estimate_tokens(text):
+    """
+    Cheaply estimate how many tokens a piece of text will use.
+    
+    Args:
+        text (str): The text to measure
+        
+    Returns:
+        int: Approximate token count (see prompt_builder.count_tokens)
+    """
+    return count_tokens(text)
+
+def summarize_turn(role, content, max_words=25):
+    """
+    Compress a conversation turn to its first sentence, capped at max_words.
+    
+    Args:
+        role (str): "user" or "assistant"
+        content (str): The full text of the turn
+        max_words (int): Maximum number of words to keep
+        
+    Returns:
+        str: A one-line summary of the turn
+    """
+    first_sentence = _SENTENCE_END.split(content.strip(), maxsplit=1)[0]
+    words = first_sentence.split()
+    if len(words) > max_words:
+        first_sentence = " ".join(words[:max_words]) + "..."
+    return f"{role}: {first_sentence}"
+
+class _Session:
+    def __init__(self):
+        self.summary_lines = []
+        self.summary_tokens = 0
+        self.turns = []
+        self.turn_tokens = 0
+        # Chat messages for the summary and turns, extended in place as turns are added
+        self.messages = []
+        self.last_seen = time.monotonic()
+        # Bumped on every change, so other processes can tell whether their copy is current
+        self.version = 0
+    
+    def dump(self):
+        state = {"summary_lines": self.summary_lines, "turns": self.turns}
+        return f"{self.version}\n{json.dumps(state)}"
+    
+    @classmethod
+    def load(cls, data):
+        version, _, state = data.partition("\n")
+        state = json.loads(state)
+        session = cls()
+        session.version = int(version)
+        session.summary_lines = state["summary_lines"]
+        session.summary_tokens = sum(estimate_tokens(line) + 1 for line in session.summary_lines)
+        session.turns = [tuple(turn) for turn in state["turns"]]
+        session.turn_tokens = sum(tokens for _, _, tokens in session.turns)
+        return session
+
+class SessionStore:
+    """
+    Session-keyed conversation history with a token budget and LRU eviction.
+    
+    Each session keeps its recent turns verbatim. When they exceed the token
+    budget the oldest turns are rolled up into a compact summary, which is itself
+    capped. Sessions idle for longer than idle_timeout, or beyond max_sessions,
+    are evicted least-recently-used first.
+    
+    With a shared state backend (SHARED_BACKEND), every change is also written
+    there and a session is reloaded whenever another process has changed it,
+    so any worker can continue any conversation. Local eviction then only
+    drops the cached copy; the backend expires sessions after idle_timeout.
+    """
+    
+    def __init__(self, token_budget=SESSION_TOKEN_BUDGET, summary_tokens=SESSION_SUMMARY_TOKENS,
+                 max_sessions=SESSION_MAX_SESSIONS, idle_timeout=SESSION_IDLE_TIMEOUT,
+                 compact_ratio=SESSION_COMPACT_RATIO, shared=None):
+        self.token_budget = token_budget
+        self.compact_ratio = compact_ratio
+        self.summary_tokens = summary_tokens
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.shared = shared_state.is_shared() if shared is None else shared
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _load_shared(self, session_id, session):
+        """Return the backend's copy of a session if it is newer than the local one."""
+        try:
+            data = shared_state.get_backend().get("session", session_id)
+        except Exception as e:
+            logging.error(f"Error loading session {session_id} from shared state: {str(e)}")
+            return session
+        if data is None:
+            if session is not None and session.version:
+                # Saved before, so another process cleared it or it expired
+                del self._sessions[session_id]
+                return None
+            return session
+        if session is not None and data.startswith(f"{session.version}\n"):
+            return session
+        session = _Session.load(data)
+        self._render_messages(session)
+        self._sessions[session_id] = session
+        return session
+    
+    def _save_shared(self, session_id, session):
+        try:
+            shared_state.get_backend().set("session", session_id, session.dump(), ttl=self.idle_timeout)
+        except Exception as e:
+            logging.error(f"Error saving session {session_id} to shared state: {str(e)}")
+    
+    def _touch(self, session_id):
+        session = self._sessions.get(session_id)
+        if self.shared:
+            session = self._load_shared(session_id, session)
+        if session is None:
+            session = _Session()
+            self._sessions[session_id] = session
+        else:
+            self._sessions.move_to_end(session_id)
+        session.last_seen = time.monotonic()
+        self._evict()
+        return session
+    
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_sessions or now - oldest.last_seen > self.idle_timeout:
+                del self._sessions[oldest_id]
+                logging.info(f"Evicted conversation session {oldest_id}")
+            else:
+                break
+    
+    def _compact(self, session):
+        if session.turn_tokens <= self.token_budget:
+            return
+        # Always keep the latest turn verbatim, even if it alone exceeds the budget
+        while session.turn_tokens > self.token_budget * self.compact_ratio and len(session.turns) > 1:
+            role, content, tokens = session.turns.pop(0)
+            session.turn_tokens -= tokens
+            line = summarize_turn(role, content)
+            session.summary_lines.append(line)
+            session.summary_tokens += estimate_tokens(line) + 1
+        while session.summary_tokens > self.summary_tokens and session.summary_lines:
+            line = session.summary_lines.pop(0)
+            session.summary_tokens -= estimate_tokens(line) + 1
+        self._render_messages(session)
+    
+    def _render_messages(self, session):
+        session.messages = []
+        if session.summary_lines:
+            session.messages.append({
+                "role": "system",
+                "content": "Summary of earlier conversation:\n" + "\n".join(session.summary_lines),
+            })
+        session.messages.extend({"role": role, "content": content} for role, content, _ in session.turns)
+    
+    def append(self, session_id, role, content):
+        """
+        Add a turn to a session's history.
+        
+        Args:
+            session_id (str): The session the turn belongs to
+            role (str): "user" or "assistant"
+            content (str): The text of the turn
+        """
+        with self._lock:
+            session = self._touch(session_id)
+            tokens = estimate_tokens(f"{role}: {content}") + 1
+            session.turns.append((role, content, tokens))
+            session.turn_tokens += tokens
+            session.messages.append({"role": role, "content": content})
+            self._compact(session)
+            session.version += 1
+            if self.shared:
+                self._save_shared(session_id, session)
+    
+    def get_messages(self, session_id):
+        """
+        Return a session's history as chat messages.
+        
+        The list is maintained as turns are added rather than rebuilt per call,
+        and earlier messages keep their exact content from turn to turn until
+        the history is next compacted.
+        
+        Args:
+            session_id (str): The session to read
+            
+        Returns:
+            list[dict]: A system message summarizing older turns (if any), then the
+                recent turns as {"role", "content"} messages, oldest first
+        """
+        with self._lock:
+            return list(self._touch(session_id).messages)
+    
+    def clear(self, session_id):
+        """Forget everything stored for a session."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self.shared:
+                try:
+                    shared_state.get_backend().delete("session", session_id)
+                except Exception as e:
+                    logging.error(f"Error clearing session {session_id} from shared state: {str(e)}")
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,152 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import logging
+
+# Where state shared between worker processes lives:
+#   "memory" - a dict in each process (single-process deployments)
+#   "sqlite" - a SQLite database in WAL mode that every process on the host opens
+SHARED_BACKEND = os.environ.get("SHARED_BACKEND", "memory")
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH", os.path.join(tempfile.gettempdir(), "medicalbot-shared.db"))
+# Expired entries are purged after this many writes
+SHARED_PURGE_EVERY = int(os.environ.get("SHARED_PURGE_EVERY", "1000"))
+
+class MemoryBackend:
+    """
+    Key-value entries in a dict, visible only to the current process.
+    
+    Values are str or bytes, grouped by namespace, with an optional time to live.
+    """
+    shared = False
+    
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._entries[(namespace, key)]
+                return None
+            return value
+    
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[(namespace, key)] = (value, expires_at)
+    
+    def delete(self, namespace, key):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+class SQLiteBackend:
+    """
+    Key-value entries in a SQLite database shared by every process that opens it.
+    
+    Same interface as MemoryBackend. Each thread uses its own connection; WAL
+    mode lets readers proceed while another process writes.
+    """
+    shared = True
+    
+    def __init__(self, path=SHARED_STATE_PATH, purge_every=SHARED_PURGE_EVERY):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB, is_text INTEGER NOT NULL, expires_at REAL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_entries_expires ON entries (expires_at)")
+    
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "pid", None) != os.getpid():
+            # Connections must not be shared across a fork
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+    
+    def get(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT value, is_text, expires_at FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        value, is_text, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(namespace, key)
+            return None
+        return value.decode("utf-8") if is_text else bytes(value)
+    
+    def set(self, namespace, key, value, ttl=None):
+        is_text = isinstance(value, str)
+        data = value.encode("utf-8") if is_text else value
+        expires_at = time.time() + ttl if ttl else None
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, is_text, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, sqlite3.Binary(data), int(is_text), expires_at)
+            )
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.purge_every == 0
+        if purge:
+            self.purge_expired()
+    
+    def delete(self, namespace, key):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+    
+    def purge_expired(self):
+        """Delete every expired entry."""
+        try:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM entries WHERE expires_at < ?", (time.time(),))
+        except sqlite3.Error as e:
+            logging.error(f"Error purging shared state: {str(e)}")
+
+_BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """
+    Return this process's shared state backend, creating it on first use.
+    
+    Returns:
+        MemoryBackend | SQLiteBackend: The backend selected by SHARED_BACKEND
+    
+    Raises:
+        ValueError: If SHARED_BACKEND names an unknown backend
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if SHARED_BACKEND not in _BACKENDS:
+                raise ValueError(f"Unknown SHARED_BACKEND: {SHARED_BACKEND} (expected one of {', '.join(_BACKENDS)})")
+            _backend = _BACKENDS[SHARED_BACKEND]()
+            logging.info(f"Using {SHARED_BACKEND} shared state backend")
+        return _backend
+
+def is_shared():
+    """True if state is shared with other processes, i.e. SHARED_BACKEND is not "memory"."""
+    return SHARED_BACKEND != "memory"
@@ -0,0 +1,191 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from doctor import encode_image, analyze_image
+from admission import AdmissionRejected, RateLimiter, stage_limiters
+
+# Start encoding and a first-pass vision analysis as soon as images are uploaded
+SPECULATIVE_VISION = os.environ.get("SPECULATIVE_VISION", "true").lower() in ("1", "true", "yes")
+# Speculations not picked up by a submit within this many seconds are dropped
+SPECULATION_TTL = float(os.environ.get("SPECULATION_TTL", "600"))
+SPECULATION_MAX_SESSIONS = int(os.environ.get("SPECULATION_MAX_SESSIONS", "1000"))
+# First-pass analyses each session (or client IP) may start: sustained per minute and burst size.
+# Every upload change can start a paid vision call, so this is separate from the submit rate limit
+SPECULATION_PER_MINUTE = float(os.environ.get("SPECULATION_PER_MINUTE", "4"))
+SPECULATION_BURST = int(os.environ.get("SPECULATION_BURST", "2"))
+
+# Context-free first pass: what the images show, written for the model that answers the patient later
+FINDINGS_PROMPT = """
+Describe the medically relevant findings in these images for a doctor who cannot see them.
+For each image give the body site, colour, size, shape, borders, texture and distribution of anything abnormal,
+then list the most likely conditions it suggests. Be objective and specific, do not address the patient,
+and keep it under 150 words.
+""".strip()
+
+# Appended to the patient's question when the findings stand in for the images
+FINDINGS_CONTEXT = "The images I uploaded were examined beforehand. Findings:\n{findings}"
+
+class Speculation:
+    """Background work started for one upload: per-image encoding and the first-pass findings."""
+    
+    def __init__(self, image_paths, encode_tasks, findings_task):
+        self.image_paths = image_paths
+        self.encode_tasks = encode_tasks
+        self.findings_task = findings_task
+        self.created = time.monotonic()
+    
+    def cancel(self):
+        for task in [*self.encode_tasks, self.findings_task]:
+            if task is None:
+                continue
+            if task.done() and not task.cancelled():
+                # Retrieve the error so asyncio does not log it as never retrieved
+                task.exception()
+            task.cancel()
+    
+    async def findings(self):
+        """
+        Wait for the first-pass findings.
+        
+        Returns:
+            str | None: The findings, or None if the first pass was skipped or failed
+        """
+        if self.findings_task is None:
+            return None
+        try:
+            return await self.findings_task
+        except asyncio.CancelledError:
+            return None
+        except Exception as e:
+            logging.error(f"Speculative image analysis failed: {str(e)}")
+            return None
+
+class SpeculativeVision:
+    """
+    Per-session speculative image work, started from the upload event and consumed by submit.
+    
+    Uploading images encodes them right away and, if the vision stage has idle
+    capacity and the session has first-pass budget left, runs a context-free
+    first-pass analysis in the background. The submit handler takes the
+    speculation for the same images and reuses the encoded images and
+    findings. Uploading different images (or clearing them) drops the earlier
+    speculation: work that has not started is cancelled, but a vision call
+    already in flight cannot be aborted and runs to completion (and is
+    billed); only its result is discarded.
+    """
+    
+    def __init__(self, enabled=SPECULATIVE_VISION, ttl=SPECULATION_TTL, max_sessions=SPECULATION_MAX_SESSIONS,
+                 per_minute=SPECULATION_PER_MINUTE, burst=SPECULATION_BURST):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.budget = RateLimiter(per_minute=per_minute, burst=burst, max_keys=max_sessions)
+        self.started = 0
+        self.used = 0
+        self.discarded = 0
+        self.throttled = 0
+        self._speculations = OrderedDict()
+    
+    def _discard(self, session_id):
+        speculation = self._speculations.pop(session_id, None)
+        if speculation is not None:
+            speculation.cancel()
+            self.discarded += 1
+    
+    def _evict(self):
+        now = time.monotonic()
+        while self._speculations:
+            oldest_id, oldest = next(iter(self._speculations.items()))
+            if len(self._speculations) > self.max_sessions or now - oldest.created > self.ttl:
+                self._discard(oldest_id)
+            else:
+                break
+    
+    def start(self, session_id, image_paths, first_pass=True, budget_key=None):
+        """
+        Start speculative work for a session's current uploads, replacing any earlier speculation.
+        
+        Must be called on the event loop.
+        
+        Args:
+            session_id (str): The uploading session
+            image_paths (list[str] | None): The uploaded files; empty or None just cancels
+            first_pass (bool): Also run the first-pass analysis, not just the encoding
+            budget_key (str): Key the first-pass budget is charged to, defaults to session_id
+        """
+        self._discard(session_id)
+        self._evict()
+        if not self.enabled or not image_paths:
+            return
+        
+        image_paths = list(image_paths)
+        encode_tasks = [
+            asyncio.create_task(asyncio.to_thread(encode_image, image_path, affinity_key=session_id))
+            for image_path in image_paths
+        ]
+        findings_task = None
+        limiter = stage_limiters["vision"]
+        # Only use spare capacity; a speculation must never queue ahead of a submitted request
+        if first_pass and limiter.in_flight < limiter.concurrency and not limiter.queued:
+            try:
+                self.budget.check(budget_key or session_id)
+            except AdmissionRejected:
+                # Submit still works, it just analyzes the images itself
+                self.throttled += 1
+                logging.info(f"Session {session_id} is out of speculation budget, encoding only")
+            else:
+                findings_task = asyncio.create_task(self._first_pass(encode_tasks))
+        self._speculations[session_id] = Speculation(image_paths, encode_tasks, findings_task)
+        self.started += 1
+        logging.info(f"Speculating on {len(image_paths)} image(s) for session {session_id}")
+    
+    async def _first_pass(self, encode_tasks):
+        encoded_images = await asyncio.gather(*encode_tasks)
+        async with stage_limiters["vision"]:
+            request = asyncio.ensure_future(asyncio.to_thread(analyze_image, FINDINGS_PROMPT, list(encoded_images)))
+            try:
+                return await asyncio.shield(request)
+            except asyncio.CancelledError:
+                # An HTTP call in flight cannot be aborted, so hold the slot until it returns
+                await asyncio.wait([request])
+                raise
+    
+    def take(self, session_id, image_paths):
+        """
+        Claim the speculation for a submit.
+        
+        Args:
+            session_id (str): The submitting session
+            image_paths (list[str] | None): The images sent with the submit
+        
+        Returns:
+            Speculation | None: The speculation if it was started for exactly these images
+        """
+        speculation = self._speculations.pop(session_id, None)
+        if speculation is None:
+            return None
+        if speculation.image_paths != list(image_paths or []):
+            speculation.cancel()
+            self.discarded += 1
+            return None
+        self.used += 1
+        return speculation
+    
+    def metrics(self) -> dict:
+        """
+        Report how many speculations were started, used by a submit and discarded.
+        
+        Returns:
+            dict: Pending, started, used and discarded counts, and first passes skipped for lack of budget
+        """
+        return {
+            "pending": len(self._speculations),
+            "started": self.started,
+            "used": self.used,
+            "discarded": self.discarded,
+            "throttled": self.throttled,
+        }
+
+speculative_vision = SpeculativeVision()
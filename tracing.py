@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Spans, metrics and traces are only recorded when enabled; otherwise span()
+# hands back a shared no-op object and nothing else happens on the hot path
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+# Append every finished trace to this JSON Lines file (disabled when unset)
+TRACE_FILE = os.environ.get("TRACE_FILE")
+# Finished traces kept in memory for the /traces endpoint
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "100"))
+# Serve /metrics (Prometheus text format) and /traces on this port (disabled when unset)
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+METRIC_PREFIX = "medicalbot"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Trace of the consultation running in the current context
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms rendered in the Prometheus text format.
+
+    Series are identified by a metric name and a dict of labels.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Per-bucket counts (made cumulative on render), sum, count
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Render every series in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name, metric_type):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+metrics = MetricsRegistry()
+metrics.describe(f"{METRIC_PREFIX}_span_duration_seconds", "Duration of instrumented operations")
+metrics.describe(f"{METRIC_PREFIX}_span_bytes_total", "Payload bytes read (in) and produced (out) by instrumented operations")
+metrics.describe(f"{METRIC_PREFIX}_tokens_total", "Model tokens reported by the provider")
+metrics.describe(f"{METRIC_PREFIX}_cache_requests_total", "Result cache lookups by outcome")
+metrics.describe(f"{METRIC_PREFIX}_traces_total", "Finished consultation traces by outcome")
+
+class Span:
+    """
+    One timed operation. Use through span() as a context manager.
+
+    Attributes set with set() end up in the request trace; the well-known
+    ones below also feed the metrics:
+        bytes_in, bytes_out      -> span_bytes_total{direction}
+        prompt_tokens,
+        completion_tokens        -> tokens_total{kind}
+        cache_hit (bool)         -> cache_requests_total{result}
+    """
+    __slots__ = ("name", "attributes", "status", "_trace", "_start")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.status = "ok"
+        self._trace = _current_trace.get()
+        self._start = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def elapsed(self):
+        return round(time.perf_counter() - self._start, 6)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        if exc_type is GeneratorExit:
+            self.status = "cancelled"
+        elif exc_type is not None:
+            self.status = "error"
+            self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        _record_span(self, duration)
+        if self._trace is not None:
+            self._trace.add_span(self, duration)
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def elapsed(self):
+        return 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(name, **attributes):
+    """
+    Time an operation and record its attributes.
+
+    Args:
+        name (str): Operation name, e.g. "vision.analyze"
+        **attributes: Initial attributes, e.g. model="whisper-large-v3"
+
+    Returns:
+        Span: A context manager; a shared no-op when tracing is disabled
+    """
+    if not TRACING_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+def _record_span(span, duration):
+    labels = {"span": span.name}
+    metrics.observe(f"{METRIC_PREFIX}_span_duration_seconds", {**labels, "status": span.status}, duration)
+    attributes = span.attributes
+    for attribute, direction in (("bytes_in", "in"), ("bytes_out", "out")):
+        if attributes.get(attribute):
+            metrics.inc(f"{METRIC_PREFIX}_span_bytes_total", {**labels, "direction": direction}, attributes[attribute])
+    for attribute, kind in (("prompt_tokens", "prompt"), ("completion_tokens", "completion")):
+        if attributes.get(attribute):
+            metrics.inc(f"{METRIC_PREFIX}_tokens_total", {**labels, "kind": kind}, attributes[attribute])
+    if "cache_hit" in attributes:
+        result = "hit" if attributes["cache_hit"] else "miss"
+        metrics.inc(f"{METRIC_PREFIX}_cache_requests_total", {**labels, "result": result})
+
+class Trace:
+    """The spans recorded while handling one consultation turn."""
+
+    def __init__(self, name, attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.spans = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, span, duration):
+        record = {
+            "name": span.name,
+            "start": round(span._start - self._start, 6),
+            "duration": round(duration, 6),
+            "status": span.status,
+            "thread": threading.current_thread().name,
+            "attributes": span.attributes,
+        }
+        with self._lock:
+            self.spans.append(record)
+
+    def to_dict(self, duration=None):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda record: record["start"])
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": round(duration if duration is not None else time.perf_counter() - self._start, 6),
+            "attributes": self.attributes,
+            "spans": spans,
+        }
+
+_recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+_trace_file_lock = threading.Lock()
+
+def start_trace(name, **attributes):
+    """
+    Start a trace and make it current, so spans opened in this context (and in
+    tasks, threads and callables created from it, see propagate()) attach to it.
+
+    Args:
+        name (str): Trace name, e.g. "consultation"
+        **attributes: Attributes describing the request, e.g. session_id
+
+    Returns:
+        Trace | None: The trace, or None when tracing is disabled
+    """
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(name, attributes)
+    _current_trace.set(trace)
+    return trace
+
+def finish_trace(trace, status="ok", **attributes):
+    """
+    Close a trace started with start_trace() and export it.
+
+    The trace is kept in the in-memory buffer served on /traces and, if
+    TRACE_FILE is set, appended to it as one JSON line.
+
+    Args:
+        trace (Trace | None): The trace returned by start_trace()
+        status (str): Outcome of the request, e.g. "ok", "error", "rejected"
+        **attributes: Extra attributes to attach, e.g. stage_timings
+    """
+    if trace is None:
+        return
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+    trace.attributes.update(attributes)
+    record = trace.to_dict()
+    record["status"] = status
+    _recent_traces.append(record)
+    metrics.inc(f"{METRIC_PREFIX}_traces_total", {"trace": trace.name, "status": status})
+    if TRACE_FILE:
+        try:
+            line = json.dumps(record, default=str)
+            with _trace_file_lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except Exception as e:
+            logging.error(f"Error writing trace: {str(e)}")
+
+def propagate(func):
+    """
+    Bind func to the current context so it sees the current trace and request deadline in another thread.
+
+    Thread pools and threading.Thread do not carry context variables over by
+    themselves (asyncio.to_thread and asyncio tasks do).
+
+    Args:
+        func (callable): Function to run later, typically in another thread
+
+    Returns:
+        callable: func wrapped to run in a copy of the current context; each call
+            gets its own copy, so the wrapper may be used from several threads at once
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+def recent_traces(limit: int = 20) -> list:
+    """
+    Return the most recently finished traces, newest first.
+
+    Args:
+        limit (int): Maximum number of traces to return
+    """
+    return list(reversed(_recent_traces))[:limit]
+
+# Extra JSON pages served by the metrics server, by path
+_status_pages = {}
+
+def add_status_page(path, func):
+    """
+    Serve what func returns as JSON on the metrics server.
+
+    Operational state (queue depths, worker and provider stats) belongs here
+    rather than on the public app: the metrics server binds to METRICS_HOST,
+    the loopback interface by default.
+
+    Args:
+        path (str): URL path, e.g. "/admission"
+        func (callable): Returns a JSON-serializable value
+    """
+    _status_pages[path] = func
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = metrics.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/traces":
+            body = json.dumps(recent_traces(TRACE_BUFFER_SIZE), default=str).encode("utf-8")
+            content_type = "application/json"
+        elif path in _status_pages:
+            try:
+                body = json.dumps(_status_pages[path](), default=str).encode("utf-8")
+            except Exception as e:
+                logging.error(f"Error rendering {path}: {str(e)}")
+                self.send_error(500)
+                return
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port, host=METRICS_HOST):
+    """
+    Serve /metrics, /traces and the status pages from a background thread.
+
+    Args:
+        port (int): Port to listen on
+        host (str): Interface to bind
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,146 @@
+import os
+import sys
+import zlib
+import atexit
+import itertools
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Worker processes for CPU-bound stages (image preprocessing, PDF rendering,
+# audio conversion); 0 runs them in the calling thread, "auto" uses one per core
+WORKER_PROCESSES = os.environ.get("WORKER_PROCESSES", "0")
+# "forkserver" forks workers from a clean process instead of the threaded server
+WORKER_START_METHOD = os.environ.get("WORKER_START_METHOD", "spawn" if sys.platform == "win32" else "forkserver")
+
+def _process_count(value):
+    if str(value).strip().lower() == "auto":
+        return os.cpu_count() or 1
+    return max(int(value), 0)
+
+class WorkerPool:
+    """
+    A fixed set of worker processes for CPU-bound work, with affinity routing.
+    
+    Each worker is a single-process executor. Calls that pass the same
+    affinity key (normally the session id) always run in the same worker, so a
+    session's work stays on one core and in one process's caches; calls
+    without a key are spread round-robin. A worker that dies is replaced on
+    the next call routed to it.
+    """
+    
+    def __init__(self, processes=WORKER_PROCESSES, start_method=WORKER_START_METHOD):
+        """
+        Args:
+            processes (int | str): Number of worker processes, or "auto" for one per core
+            start_method (str): multiprocessing start method for the workers
+        """
+        self.processes = _process_count(processes)
+        self.start_method = start_method
+        self.calls = [0] * self.processes
+        self._executors = [None] * self.processes
+        self._round_robin = itertools.count()
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.processes > 0
+    
+    def worker_for(self, affinity_key=None):
+        """
+        Pick the worker a call is routed to.
+        
+        Args:
+            affinity_key (str | None): Calls with equal keys go to the same worker
+        
+        Returns:
+            int: Index of the worker
+        """
+        if affinity_key is None:
+            return next(self._round_robin) % self.processes
+        return zlib.crc32(str(affinity_key).encode("utf-8")) % self.processes
+    
+    def _executor(self, index):
+        with self._lock:
+            executor = self._executors[index]
+            if executor is None:
+                executor = ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context(self.start_method)
+                )
+                self._executors[index] = executor
+                logging.info(f"Started worker process {index + 1}/{self.processes}")
+            return executor
+    
+    def _replace(self, index, executor):
+        with self._lock:
+            if self._executors[index] is executor:
+                self._executors[index] = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def call(self, affinity_key, func, *args, **kwargs):
+        """
+        Run func in a worker process and wait for its result.
+        
+        func and its arguments must be picklable (module-level functions and
+        plain data). With no worker processes configured, func runs in the
+        calling thread.
+        
+        Args:
+            affinity_key (str | None): Routing key, normally the session id
+            func (callable): Module-level function to run
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+        
+        Returns:
+            Any: What func returned
+        
+        Raises:
+            Exception: Whatever func raised, or BrokenProcessPool if the worker died
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        
+        index = self.worker_for(affinity_key)
+        executor = self._executor(index)
+        with self._lock:
+            self.calls[index] += 1
+        try:
+            return executor.submit(func, *args, **kwargs).result()
+        except BrokenProcessPool:
+            logging.error(f"Worker process {index + 1} died while running {func.__name__}; replacing it")
+            self._replace(index, executor)
+            raise
+    
+    def start(self):
+        """Start every worker now instead of on first use (a no-op without worker processes)."""
+        for index in range(self.processes):
+            # A no-op call makes the executor spawn its process
+            self._executor(index).submit(int).result()
+    
+    def stats(self) -> dict:
+        """
+        Report the pool size and how many calls each worker received.
+        
+        Returns:
+            dict: Process count, start method and per-worker call counts
+        """
+        with self._lock:
+            return {
+                "processes": self.processes,
+                "start_method": self.start_method,
+                "calls": list(self.calls),
+            }
+    
+    def shutdown(self):
+        """Stop every worker process."""
+        with self._lock:
+            executors, self._executors = self._executors, [None] * self.processes
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+# Shared by every module that offloads CPU-bound work
+workers = WorkerPool()
+atexit.register(workers.shutdown)